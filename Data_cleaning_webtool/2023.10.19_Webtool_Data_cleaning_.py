@@ -5,8 +5,29 @@ import streamlit as st
 import scipy.stats as sp
 import matplotlib.pyplot as plt
 import seaborn as sns
-import base64
-import io
+import os
+import shutil
+import time
+import zipfile
+import tempfile
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+# Functions to read the files and replay the cleaning steps (cleaning_engine.py in this folder)
+from cleaning_engine import (pa, feather, zstandard, detect_compression, get_zip_members, open_compressed_upload,
+                             sniff_csv_schema, read_in_chunks, get_arrow_schema, get_arrow_index_columns,
+                             dataframe_to_arrow_table, arrow_table_to_dataframe, get_excel_sheet_names, read_excel_sheet,
+                             read_uploaded_file,
+                             download_formats, write_download_file,
+                             duplicate_actions, get_key_columns, summarize_duplicates, find_duplicate_groups,
+                             remove_duplicates, find_rows_with_missing_values, remove_rows_with_missing_values,
+                             fill_missing_values, find_duplicate_columns, get_redundant_columns, delete_columns,
+                             has_non_finite_values, convert_columns, count_split_parts, get_split_column_names,
+                             clean_dataframe, clean_file_in_chunks, yaml, recipe_formats,
+                             dump_recipe, load_recipe, clean_batch_file, copy_dataframe, measure_allocations)
 
 # Webtool sidebar
 st.title('Data cleaning webtool')
@@ -18,8 +39,11 @@ st.sidebar.markdown('[Managing duplicate values](#manage-duplicates)')
 st.sidebar.markdown('[Managing missing values](#manage-missing)')
 st.sidebar.markdown('[Data type converter](#convert-int-to-decimal)')
 st.sidebar.markdown('[Split or concatenate columns](#split-concatenate-columns)')
+st.sidebar.markdown('[Batch mode](#batch-mode)')
 st.sidebar.markdown('[Date-to-Gene converter](#convert-dates-to-gene-names)')  # Provided the link to the gene-to-date converter
 show_docs = st.sidebar.checkbox('**Check documentation**', value = True)  # Need to add more documentation - complete demo with snapshots  
+# The cleaning steps never copy the whole data (pandas copy-on-write), this shows how much memory every step allocates
+show_allocations = st.sidebar.checkbox('Show the memory used by every cleaning step')
 
 # Section 1:  Doucmentation
 if show_docs:
@@ -33,7 +57,7 @@ if show_docs:
     st.write("4. Column splitting and concatenation")
     st.subheader("How do I use this web tool?")
     st.subheader("Getting started")
-    st.write("To get yourself started, first you should choose a data file type that you want to be cleaned. We allow you to upload .xls, .xlsx, .csv, and .tsv files. Make sure that your file is of long format instead of a wide format. If you have not uploaded your file, an example file is already loaded. So you can still explore the functions of this webtool and check out what best suits the needs for your data.")
+    st.write("To get yourself started, first you should choose a data file type that you want to be cleaned. We allow you to upload .xls, .xlsx, .csv, .tsv, .parquet and .feather files. Make sure that your file is of long format instead of a wide format. If you have not uploaded your file, an example file is already loaded. So you can still explore the functions of this webtool and check out what best suits the needs for your data.")
     st.subheader('Navigation')
     st.write('You can navigate through the webtool by scrolling up and down the main title page. For easy navigation, we have the main headings and a few notes on the datafile tagged in the sidebar on the left for easy access to the file section!')
     st.subheader("Functions")
@@ -46,7 +70,7 @@ if show_docs:
     st.write("4. Split or concatenate columns")
     st.write("This function allows you to either split or concatenate columns. You need to choose whether you wish to initiate this function first with a dropdown menu. Then you can choose whether you want to perform a split, a concatenation, or both. Additionally post-splitting, you can choose which columns you want to keep and which columns you want to delete.")
     st.subheader("Save your file")
-    st.write("After all the functions are successfully performed, you can save your cleaned file by clicking 'Download Excel File'. And you are good to perform your downstream processes on your clean date file!")
+    st.write("After all the functions are successfully performed, you can save your cleaned file as an Excel, CSV, Parquet or Feather file by clicking the 'Prepare file' button and then the download button. And you are good to perform your downstream processes on your clean date file!")
     st.subheader("Extra resources")
     st.write("Finally, to pay homage to our greatest lecturer ever, Dr. Chan Kuan Rong, we have included a link to his webtool where you can convert dates that were converted automatically from gene names by Excel back to the original gene names but with the new approved format of gene names that even Excel cannot tamper with. You can download your clean file and proceed to the Date-to-Gene tool with the included link if you so wish. Do check out the documentation in their webtool for more information.")
     st.write("This webtool was made as part of an assignment for the DUke NUS Medical School, GMS6907 module. Creators: Shree Pooja, Qing Xin, Vinaya Venkat, He Shan")
@@ -55,31 +79,513 @@ if show_docs:
 st.markdown('<a name="upload-anchor"></a>', unsafe_allow_html=True)  # Create an anchor for this section
 st.subheader('1. Uploading your datafile')
 
-option = st.selectbox('Please choose the file format you are uploading', ('None','Excel', 'CSV', 'TSV'))
+option = st.selectbox('Please choose the file format you are uploading', ('None','Excel', 'CSV', 'TSV', 'Parquet', 'Feather'))
 st.write('You have selected:', option)
 
 upload = st.file_uploader(f'Upload your file here')
 
+# Streaming mode for large CSV/TSV files: only the first chunk is loaded to preview the cleaning steps,
+# the whole file is then cleaned chunk by chunk when you download it so the memory use stays flat
+streaming_mode = False
+if option in ('CSV', 'TSV'):
+    streaming_mode = st.checkbox('My file is very large: read and clean it in chunks (streaming mode)')
+    if streaming_mode:
+        chunk_size = int(st.number_input('Number of rows per chunk:', min_value=1000, value=100000, step=10000))
+    # Compact data types are chosen from a sample of the file and roughly halve the memory used by the data
+    use_compact_dtypes = st.checkbox('Use compact data types to save memory (category, int32)', value=True)
+
 st.sidebar.subheader('*Please note:*')
 st.sidebar.write('*1. The webtool will consider the first column in the file as the index*')
-st.sidebar.write('*2. Add an Excel file with only one sheet in it to prevent errors*')
+st.sidebar.write('*2. For Excel files with several sheets, choose the sheet to clean below the upload*')
+
+# Cache of the parsed uploads, so a rerun of the script (after every click) does not parse the same file again
+# The cache is shared by all users and the least recently used files are removed when it is full
+parse_cache_max_mb = 1024
+
+@st.cache_resource
+def get_parse_cache():
+    return {'entries': OrderedDict(), 'size': 0, 'lock': threading.Lock()}
+
+# Function to compute a fingerprint of the content of the uploaded file
+# For zip archives the name of the file inside the archive is added, since one archive can hold several files
+# The whole file is only hashed once per upload (file_id): the hash is kept in the session state, so a rerun
+# after a click costs nothing that grows with the size of the file. The hash is passed down as upload_hash.
+def get_upload_hash(upload, member=None):
+    upload_id = (upload.file_id, member)
+    cached = st.session_state.get('upload_hash')
+    if cached is None or cached[0] != upload_id:
+        hasher = hashlib.blake2b(upload.getbuffer(), digest_size=16)
+        hasher.update(str(member).encode())
+        cached = (upload_id, hasher.hexdigest())
+        st.session_state['upload_hash'] = cached
+    return cached[1]
+
+# Function to build the cache key from the file content (upload_hash), the file format and the read options
+def get_parse_cache_key(upload_hash, file_format, read_options):
+    return (upload_hash, file_format, repr(sorted(read_options.items())))
+
+# Function to check if an uploaded file was already read before with the same options
+def is_upload_cached(upload_hash, file_format, **read_options):
+    cache = get_parse_cache()
+    with cache['lock']:
+        return get_parse_cache_key(upload_hash, file_format, read_options) in cache['entries']
+
+# Function to convert an uploaded file to a DataFrame, or to take it from the cache if the same file was read before
+# A (lazy, with copy-on-write) copy is returned, so the cached DataFrame can never be changed by a user
+def read_uploaded_file_cached(upload, upload_hash, file_format, **read_options):
+    key = get_parse_cache_key(upload_hash, file_format, read_options)
+    cache = get_parse_cache()
+    with cache['lock']:
+        if key in cache['entries']:
+            cache['entries'].move_to_end(key)
+            return copy_dataframe(cache['entries'][key][0])
+
+    df = read_uploaded_file(upload, file_format, **read_options)
+    add_to_cache(cache, key, df, parse_cache_max_mb)
+    return copy_dataframe(df)
+
+# Function to add a result (usually a DataFrame) to one of the caches and remove the least recently used entries
+# until the cache fits in its memory limit again. Results larger than the whole cache are not added.
+def add_to_cache(cache, key, value, max_mb):
+    size = int(np.sum(value.memory_usage(index=True, deep=True))) if hasattr(value, 'memory_usage') else 0
+    with cache['lock']:
+        if key not in cache['entries'] and size <= max_mb * 1024 * 1024:
+            cache['entries'][key] = (value, size)
+            cache['size'] += size
+            while cache['size'] > max_mb * 1024 * 1024:
+                _, (_, removed_size) = cache['entries'].popitem(last=False)
+                cache['size'] -= removed_size
+
+# Long steps run in a background thread, so the page shows a progress bar and a cancel button instead of freezing.
+# The running tasks of a user are kept in the session state under a name (one task per name). When the page is run
+# again while a task is still running (after another click), the new run waits for the same task instead of starting
+# it again; when the options of the task have changed, the old task is dropped and a new one is started.
+background_wait_seconds = 0.2
+
+@st.cache_resource
+def get_background_executor():
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='data_cleaning')
+
+# Raised in a background task by its progress function when the user cancelled the task
+class TaskCancelled(Exception):
+    pass
+
+# Function to check if a task with this name and key was started before and not finished yet
+def has_background_task(name, key):
+    task = st.session_state.get('background_tasks', {}).get(name)
+    return task is not None and task['key'] == key
+
+# Function to run function(*args) in a background thread and wait for its result while showing a progress bar
+# With report_progress the function gets a progress function as keyword argument, which it calls with the fraction
+# done (or a number of rows), and which stops the function when the user clicks 'Cancel'.
+# Functions without progress reports keep running after a cancel, but their result is dropped.
+def run_in_background(name, key, label, function, *args, report_progress=False):
+    tasks = st.session_state.setdefault('background_tasks', {})
+    task = tasks.get(name)
+    if task is not None and task['key'] != key:
+        task['cancel'].set()
+        task['future'].cancel()
+        task = None
+    if task is None:
+        task = {'key': key, 'cancel': threading.Event(), 'progress': None, 'started': time.time()}
+        def progress(done):
+            if task['cancel'].is_set():
+                raise TaskCancelled()
+            task['progress'] = done
+        keywords = {'progress': progress} if report_progress else {}
+        task['future'] = get_background_executor().submit(function, *args, **keywords)
+        tasks[name] = task
+
+    if task['cancel'].is_set():
+        st.warning(f'{label} was cancelled.')
+        if st.button('Start again', key=f'restart_{name}'):
+            del tasks[name]
+            st.rerun()
+        st.stop()
+    wait([task['future']], timeout=background_wait_seconds)
+    if not task['future'].done():
+        progress_bar = st.progress(0.0, text=f'{label}...')
+        if st.button('Cancel', key=f'cancel_{name}'):
+            task['cancel'].set()
+            st.rerun()
+        # Every update of the progress bar lets Streamlit stop this run when the user clicks somewhere else
+        while not task['future'].done():
+            done = task['progress']
+            seconds = f'{time.time() - task["started"]:.0f} s'
+            if isinstance(done, float):
+                progress_bar.progress(min(done, 1.0), text=f'{label}... {done:.0%} ({seconds})')
+            else:
+                rows = f'{done} rows, ' if done is not None else ''
+                progress_bar.progress(0.0, text=f'{label}... ({rows}{seconds})')
+            time.sleep(0.25)
+        progress_bar.empty()
+    del tasks[name]
+    return task['future'].result()
+
+# Cache of the results of the cleaning stages in sections 3 to 5, so a rerun after a click only recomputes
+# the stages after the widget that changed. A result is stored under a key made of the key of its input data
+# and the options of the stage, so the data itself is never hashed again. The engine functions never change
+# their input, so the cached DataFrames are shared as they are.
+stage_cache_max_mb = 1024
+
+@st.cache_resource
+def get_stage_cache():
+    return {'entries': OrderedDict(), 'size': 0, 'lock': threading.Lock()}
+
+# Function to run a cleaning stage (a function of cleaning_engine) or to take its result from the cache
+# Stages that are not cached run in the background (see run_in_background)
+# Returns the result and its key, which is the data key of the next stage
+def run_cleaning_stage(stage, df, data_key, *options):
+    key = hashlib.blake2b(repr((data_key, stage.__name__, options)).encode(), digest_size=16).hexdigest()
+    label = stage.__name__.replace('_', ' ').capitalize()
+    snapshot = load_snapshot(key)
+    if snapshot is not None:
+        if show_allocations:
+            st.caption(f'{label}: taken from the snapshots of this session, no memory allocated')
+        return snapshot, key
+    cache = get_stage_cache()
+    with cache['lock']:
+        result = cache['entries'].get(key)
+        if result is not None:
+            cache['entries'].move_to_end(key)
+            result = result[0]
+    if result is None:
+        if show_allocations:
+            result, allocated = run_in_background(stage.__name__, (key, 'measured'), label, measure_allocations, stage, df, *options)
+            st.caption(f"{label}: {format_size(allocated['kept'])} allocated for the result, "
+                       f"at most {format_size(allocated['peak'])} at once")
+        else:
+            result = run_in_background(stage.__name__, key, label, stage, df, *options)
+        add_to_cache(cache, key, result, stage_cache_max_mb)
+    elif show_allocations:
+        st.caption(f'{label}: taken from the cache, no memory allocated')
+    if isinstance(result, pd.DataFrame):
+        save_snapshot(key, result)
+    return result, key
+
+# Function to write a number of bytes in a readable way
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'bytes' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+# Store of the DataFrames made by the cleaning stages of this session (a snapshot per stage, under its stage key)
+# The shared stage cache can drop a result at any time when other users need the memory, the snapshots of a session
+# are kept until the session ends. When they use more than session_memory_budget_mb, the least recently used
+# snapshots are written to disk as Feather files and read back when they are needed again (after an undo, for example).
+# Columns with mixed values are stored as text, with their other values in the metadata of the file, so a snapshot
+# read back from disk has the same values and data types as before it was written (see dataframe_to_arrow_table).
+session_memory_budget_mb = 256
+
+def get_snapshot_store():
+    if 'snapshot_store' not in st.session_state:
+        st.session_state['snapshot_store'] = {'entries': OrderedDict(), 'size': 0, 'folder': None}
+    return st.session_state['snapshot_store']
+
+# The snapshot files of a session are kept in its own private folder (made by mkdtemp, so only the server can read it),
+# which is removed with its files when the session and its snapshot store are dropped
+def get_snapshot_path(store, key):
+    if store['folder'] is None:
+        store['folder'] = tempfile.TemporaryDirectory(prefix='data_cleaning_snapshots_', ignore_cleanup_errors=True)
+    return os.path.join(store['folder'].name, f'snapshot_{key}.arrow')
+
+# Function to write the least recently used snapshots to disk until the snapshots in memory fit in the budget
+# The most recent snapshot always stays in memory, and without pyarrow all snapshots stay in memory
+def evict_snapshots(store):
+    if pa is None:
+        return
+    for key, (df, size) in list(store['entries'].items())[:-1]:
+        if store['size'] <= session_memory_budget_mb * 1024 * 1024:
+            break
+        if df is None:
+            continue
+        path = get_snapshot_path(store, key)
+        # A snapshot that was read back is a memory map of its file, so an existing file is never written again
+        if not os.path.exists(path):
+            feather.write_feather(dataframe_to_arrow_table(df), path + '.part', compression='uncompressed')
+            os.replace(path + '.part', path)
+        store['entries'][key] = (None, 0)
+        store['size'] -= size
+
+# Function to add a DataFrame to the snapshots of this session
+def save_snapshot(key, df):
+    store = get_snapshot_store()
+    if key in store['entries'] and store['entries'][key][0] is not None:
+        store['entries'].move_to_end(key)
+        return
+    size = int(np.sum(df.memory_usage(index=True, deep=True)))
+    store['entries'][key] = (df, size)
+    store['entries'].move_to_end(key)
+    store['size'] += size
+    evict_snapshots(store)
+
+# Function to get a snapshot of this session, from memory or from disk, or None if there is none
+def load_snapshot(key):
+    store = get_snapshot_store()
+    if key not in store['entries']:
+        return None
+    df = store['entries'][key][0]
+    if df is None:
+        try:
+            df = read_staged_file(get_snapshot_path(store, key))
+        except OSError:
+            del store['entries'][key]
+            return None
+        save_snapshot(key, df)
+    store['entries'].move_to_end(key)
+    return df
+
+# History of the cleaning steps of this session, for undo and redo
+# Every time the cleaning steps change, a version is added with the values of the widgets of sections 2 to 6.
+# Undo and redo put the widgets back to the values of another version; the DataFrames of that version are then
+# taken from the snapshots instead of being cleaned again.
+cleaning_widget_keys = ('drop_duplicate_columns', 'duplicates_column', 'duplicates_key_columns', 'duplicates_match',
+                        'handle_duplicates', 'index_duplicates_action', 'duplicates_action', 'missing_action', 'fill_value', 'applied_fill_value', 'convert', 'conversion_type',
+                        'convert_columns', 'non_finite_action', 'replace_value', 'split_concat',
+                        'split_concat_operation', 'split_column', 'split_separator', 'concat_columns',
+                        'concat_separator', 'columns_action', 'columns_to_keep', 'columns_to_delete')
+
+def get_history():
+    if 'history' not in st.session_state:
+        st.session_state['history'] = {'source': None, 'versions': [], 'position': -1}
+    return st.session_state['history']
+
+# Function to add a version when the cleaning steps have changed, a new upload starts a new history
+def record_version(source_key, steps):
+    history = get_history()
+    if history['source'] != source_key:
+        history.update({'source': source_key, 'versions': [], 'position': -1})
+    widget_values = {key: st.session_state[key] for key in cleaning_widget_keys if key in st.session_state}
+    position = history['position']
+    if position >= 0 and history['versions'][position]['steps'] == steps:
+        # Same steps, only the view changed (for example the column checked for duplicates)
+        history['versions'][position]['widgets'] = widget_values
+        return
+    del history['versions'][position + 1:]
+    history['versions'].append({'steps': [dict(step) for step in steps], 'widgets': widget_values})
+    history['position'] = len(history['versions']) - 1
+
+# Function to put the widgets back to the values of a version, it runs as a button callback before the next run
+def restore_version(position):
+    history = get_history()
+    history['position'] = position
+    widget_values = history['versions'][position]['widgets']
+    for key in cleaning_widget_keys:
+        if key in widget_values:
+            st.session_state[key] = widget_values[key]
+        elif key in st.session_state:
+            del st.session_state[key]
+
+# Function to describe a cleaning step in a few words, for the undo and redo buttons
+def describe_step(step):
+    if step['step'] == 'duplicates':
+        match = f" ({step['match']})" if step.get('match', 'exact') != 'exact' else ''
+        return f"duplicates in {'the index' if step['use_index'] else ' + '.join(map(str, get_key_columns(step['column'])))}{match}"
+    if step['step'] == 'missing':
+        return f"{step['action']} missing values"
+    if step['step'] == 'convert':
+        return f"convert {', '.join(map(str, step['columns']))}"
+    return step['step'].replace('_', ' ')
+
+# Large uploads are staged on disk: the file is copied to a staging folder and converted once to an
+# uncompressed Feather (Arrow IPC) file. The DataFrame is then read from a memory map of that file, so the
+# operating system shares the data between all users who upload the same file instead of copying it for each of them
+staging_threshold_mb = 100
+staging_folder = os.path.join(tempfile.gettempdir(), 'data_cleaning_webtool')
+staging_max_age_hours = 24
+staging_cleanup_interval_minutes = 10
+batch_folder_prefix = 'batch_'
+
+@st.cache_resource
+def get_staging_lock():
+    return threading.Lock()
+
+# Function to check if an upload is large enough to be staged on disk
+def should_stage_upload(upload):
+    return pa is not None and upload.getbuffer().nbytes > staging_threshold_mb * 1024 * 1024
+
+# Function to get the path of the staged Feather file for an upload and its read options
+def get_staging_path(upload_hash, file_format, read_options):
+    key = repr(get_parse_cache_key(upload_hash, file_format, read_options))
+    return os.path.join(staging_folder, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '.arrow')
+
+# Function to remove staged files (and folders left by a batch that was stopped) that have not been used for a while
+# Other folders are left alone, for example the folder of the cleaning service (cleaning_service.py)
+def remove_old_staged_files():
+    now = time.time()
+    for file_name in os.listdir(staging_folder):
+        path = os.path.join(staging_folder, file_name)
+        try:
+            if now - os.path.getmtime(path) > staging_max_age_hours * 3600:
+                if not os.path.isdir(path):
+                    os.remove(path)
+                elif file_name.startswith(batch_folder_prefix):
+                    shutil.rmtree(path)
+        except OSError:
+            # The file was removed by another session at the same time
+            pass
+
+@st.cache_resource
+def get_staging_cleanup_state():
+    return {'last_cleanup': 0.0}
+
+# Function to make the staging folder before a file is written to it (staged uploads, download files and batch archives)
+# The old files are removed here as well, at most once every staging_cleanup_interval_minutes for all sessions
+def prepare_staging_folder():
+    os.makedirs(staging_folder, exist_ok=True)
+    cleanup_state = get_staging_cleanup_state()
+    if time.time() - cleanup_state['last_cleanup'] > staging_cleanup_interval_minutes * 60:
+        cleanup_state['last_cleanup'] = time.time()
+        remove_old_staged_files()
+
+# Function to copy an upload to disk and convert it to a memory-mappable Feather file (only the first time)
+# Only one large file is converted at a time, so several users uploading at once do not multiply the memory use
+def stage_upload(upload, upload_hash, file_format, **read_options):
+    arrow_path = get_staging_path(upload_hash, file_format, read_options)
+    with get_staging_lock():
+        if os.path.exists(arrow_path):
+            os.utime(arrow_path)
+            return arrow_path
+        prepare_staging_folder()
+        upload.seek(0)
+        with tempfile.NamedTemporaryFile(dir=staging_folder, delete=False) as raw_file:
+            shutil.copyfileobj(upload, raw_file, 16 * 1024 * 1024)
+        try:
+            with open(raw_file.name, 'rb') as staged_upload:
+                df = read_uploaded_file(staged_upload, file_format, **read_options)
+            table = dataframe_to_arrow_table(df)
+            del df
+            # Write to a temporary name first, so no other user can read a half written file
+            feather.write_feather(table, raw_file.name + '.arrow', compression='uncompressed')
+            os.replace(raw_file.name + '.arrow', arrow_path)
+        finally:
+            os.remove(raw_file.name)
+    return arrow_path
+
+# Function to read a staged Feather file through a memory map
+# Mixed columns (stored as text by dataframe_to_arrow_table) get their original values and data type back
+def read_staged_file(arrow_path, columns=None):
+    table = feather.read_table(arrow_path, columns=columns, memory_map=True)
+    return arrow_table_to_dataframe(table, split_blocks=True)
+
+# Function to check if an upload was already read (or staged) before with the same options
+def is_upload_ready(upload, upload_hash, file_format, **read_options):
+    if should_stage_upload(upload):
+        return os.path.exists(get_staging_path(upload_hash, file_format, read_options))
+    return is_upload_cached(upload_hash, file_format, **read_options)
+
+# Function to convert an upload to a DataFrame: large files are read from their staged copy on disk,
+# smaller files from the cache of parsed uploads
+def load_uploaded_file(upload, upload_hash, file_format, **read_options):
+    if should_stage_upload(upload):
+        return read_staged_file(stage_upload(upload, upload_hash, file_format, **read_options))
+    return read_uploaded_file_cached(upload, upload_hash, file_format, **read_options)
+
+# Function to load the example datafile that is shipped with the webtool
+# It is only loaded when no file is uploaded, and then kept in memory once for all users
+# The Parquet copy is already parsed, the Excel file is only used when pyarrow is not installed
+# The Parquet copy was written with dataframe_to_arrow_table from the Excel file, so it gives the same DataFrame
+# (also the gene name that Excel turned into a date)
+demo_dataset_folder = os.path.dirname(os.path.abspath(__file__))
+
+@st.cache_resource
+def load_demo_dataset():
+    parquet_path = os.path.join(demo_dataset_folder, 'Streamlit_demo_dataset.parquet')
+    if pa is not None and os.path.exists(parquet_path):
+        with open(parquet_path, 'rb') as parquet_file:
+            return read_uploaded_file(parquet_file, 'Parquet')
+    return pd.read_excel(os.path.join(demo_dataset_folder, 'Streamlit_demo_dataset.xlsx'), index_col = 0)
+
+# Number of rows shown in the quick preview of an Excel file
+excel_preview_rows = 100
 
 # Convert the uploaded file to a DataFrame
+# data_key identifies the data in df for the stage cache: the uploaded file and the options used to read it
 df = None
+data_key = None
+
+# List of the cleaning steps chosen in the sections below, so they can be replayed on every chunk in streaming mode
+cleaning_steps = []
 
 if upload is not None:
-    if option == 'Excel':
-        df = pd.read_excel(upload, index_col = 0)
-    elif option == 'CSV':
-        df = pd.read_csv(upload, index_col = 0)
-    elif option == 'TSV':
-        df = pd.read_csv(upload, sep='\t', index_col = 0)
+    compression = detect_compression(upload, option)
+    zip_member = None
+    if compression is not None:
+        if compression == 'zstd' and zstandard is None:
+            st.error('Reading zstd compressed files needs the zstandard package. Please install it with: pip install zstandard')
+            st.stop()
+        if compression == 'zip':
+            zip_members = get_zip_members(upload)
+            zip_member = st.selectbox('Select the file in the zip archive to clean:', zip_members) if len(zip_members) > 1 else zip_members[0]
+        st.write(f'Your file is compressed ({compression}), it is decompressed while it is read.')
+    # The fingerprint of the (compressed) upload, it is the start of every cache key of the data
+    upload_hash = get_upload_hash(upload, zip_member)
+    if compression is not None:
+        upload = open_compressed_upload(upload, option, compression, zip_member)
+    if option in ('CSV', 'TSV'):
+        csv_schema = sniff_csv_schema(upload, ',' if option == 'CSV' else '\t', use_compact_dtypes)
+        st.write(f"Detected delimiter: {csv_schema['sep']!r}, encoding: {csv_schema['encoding']}")
+    if streaming_mode:
+        file_sep = csv_schema['sep']
+        df = next(read_in_chunks(upload, file_sep, chunk_size, csv_schema['encoding'], csv_schema['dtype']))
+        data_key = ('first chunk', get_parse_cache_key(upload_hash, option, csv_schema), chunk_size)
+        st.write(f'Streaming mode: the cleaning steps below are previewed on the first {len(df)} rows of your file. The whole file is cleaned chunk by chunk when you download it.')
+    elif option in ('Parquet', 'Feather'):
+        if pa is None:
+            st.error('Reading Parquet and Feather files needs the pyarrow package. Please install it with: pip install pyarrow')
+            st.stop()
+        # Only the columns you select are read from the file, which is much faster for large files
+        schema = get_arrow_schema(upload, option)
+        index_columns = get_arrow_index_columns(schema)
+        data_columns = [name for name in schema.names if name not in index_columns and not name.startswith('__index_level_')]
+        # An empty selection is passed as None, so "all columns" has the same cache key however it was chosen
+        columns_to_load = st.multiselect('Select the columns to load (leave empty to load all columns):', data_columns) or None
+        df = load_uploaded_file(upload, upload_hash, option, columns=columns_to_load)
+        data_key = get_parse_cache_key(upload_hash, option, {'columns': columns_to_load})
+    elif option == 'Excel':
+        sheet_names = get_excel_sheet_names(upload)
+        sheet_name = st.selectbox('Select the sheet to clean:', sheet_names) if len(sheet_names) > 1 else sheet_names[0]
+        if not is_upload_ready(upload, upload_hash, option, sheet_name=sheet_name):
+            # Show the first rows of the sheet straight away while the whole sheet is being read
+            st.write(f'Preview of the first {excel_preview_rows} rows of your file:')
+            st.dataframe(read_excel_sheet(upload, sheet_name, nrows=excel_preview_rows))
+        df = load_uploaded_file(upload, upload_hash, option, sheet_name=sheet_name)
+        data_key = get_parse_cache_key(upload_hash, option, {'sheet_name': sheet_name})
+    elif option in ('CSV', 'TSV'):
+        df = load_uploaded_file(upload, upload_hash, option, **csv_schema)
+        data_key = get_parse_cache_key(upload_hash, option, csv_schema)
+    else:
+        st.warning('Please choose the file format you are uploading.')
+        st.stop()
 else:
     # Load an example datafile 
-    url = "https://raw.githubusercontent.com/VinayaVenkat26/GSMV6907-Group1/main/Data_cleaning_webtool/Streamlit_demo_dataset.xlsx"
-    df = pd.read_excel(url,index_col = 0) 
+    df = copy_dataframe(load_demo_dataset())
+    data_key = 'demo dataset'
     st.write('No file uploaded. Showing example data.')
     st.write(df)
+
+# Key of the uploaded data before cleaning, the history of the cleaning steps starts again when it changes
+source_key = data_key
+
+# Columns with the same contents under different names (for example a sample exported twice in a merged export) are
+# found by one hash of every column. Dropping the copies first makes every later step work on fewer columns
+duplicate_columns, _ = run_cleaning_stage(find_duplicate_columns, df, data_key)
+if duplicate_columns:
+    rows_checked = f'the first {len(df):,} rows of ' if streaming_mode else ''
+    st.write(f'Columns with the same contents in {rows_checked}your file: ' +
+             '; '.join(' = '.join(f'"{column}"' for column in group) for group in duplicate_columns))
+    if st.checkbox('Drop the copies (the first column of every group is kept)', key='drop_duplicate_columns'):
+        redundant_columns = get_redundant_columns(duplicate_columns)
+        df, data_key = run_cleaning_stage(delete_columns, df, data_key, redundant_columns)
+        # The step is recorded without column names: the columns are compared again in every file the steps are
+        # replayed on (and over the whole file for a download in chunks), so a column is never dropped by its name only
+        cleaning_steps.append({'step': 'drop_duplicate_columns'})
+        st.write(f'{len(redundant_columns)} column{"s" if len(redundant_columns) > 1 else ""} dropped: ' +
+                 ', '.join(f'"{column}"' for column in redundant_columns))
+        if streaming_mode:
+            st.write('The download compares these columns over the whole file and only drops the ones that are the same in every row.')
     
    
 
@@ -89,113 +595,117 @@ else:
 st.markdown('<a name="manage-duplicates"></a>', unsafe_allow_html=True)  # Create an anchor for this section
 st.subheader('2. Managing duplicate values')
 
-# Function to check for duplicates in a specified column or index
-def check_duplicates_in_column_or_index(df, column_name, use_index=False):
+# Function to name the column, the columns of a composite key or the index in the messages
+def describe_duplicate_key(column_name, use_index=False):
+    if use_index:
+        return 'index'
+    key_columns = get_key_columns(column_name)
+    if len(key_columns) == 1:
+        return f'column "{key_columns[0]}"'
+    return 'columns ' + ', '.join(f'"{column}"' for column in key_columns)
+
+# Ways to match duplicate values, shown in the dropdown menu (see duplicate_matches)
+duplicate_match_labels = {
+    'Exact values': 'exact',
+    'Ignore case, spaces and version suffixes (TP53 = tp53 = TP53.1)': 'normalized',
+    'Also small typos in the letters (similar values)': 'similar',
+}
+
+# Number of duplicate groups on one page of the rows of the duplicate groups
+duplicate_groups_per_page = 50
+
+# Function to check for duplicates in a specified column, several columns together or the index
+# Only a summary of the duplicates is sent to the browser; the rows of the groups are shown a page at a time and only
+# when asked for, the largest groups first (near-duplicates are grouped by their matched value)
+def check_duplicates_in_column_or_index(df, data_key, column_name, use_index=False, match='exact'):
     if df is not None and not df.empty:
-        if use_index:
-            index_dups = df.index.duplicated().any()
-            if index_dups:
-                duplicated_values = df[df.index.duplicated(keep=False)]
-                st.write('Duplicate values in index:')
-                st.write(duplicated_values)
-                return 'Duplicate values in index found.', duplicated_values
-            else:
-                return 'No duplicate values in index were found.'
-        else:
-            if column_name in df.columns:
-                col_dups = df[column_name].duplicated().any()
-                if col_dups:
-                    duplicated_values = df[df[column_name].duplicated(keep=False)]
-                    st.write(f'Duplicate values in column "{column_name}":')
-                    duplicates_only_df = st.write(duplicated_values)
-                    return f'Duplicate values in column "{column_name}" found.'
-                else:
-                    return f'No duplicate values in column "{column_name}" were found.', duplicated_values
-            else:
-                return f'Column "{column_name}" not found in the DataFrame.'
+        if not use_index:
+            missing_columns = [column for column in get_key_columns(column_name) if column not in df.columns]
+            if missing_columns:
+                return f'Column "{missing_columns[0]}" not found in the DataFrame.'
+        name = describe_duplicate_key(column_name, use_index)
+        summary, _ = run_cleaning_stage(summarize_duplicates, df, data_key, column_name, use_index, match)
+        if match != 'exact':
+            name = f'{name} (near-duplicates)'
+        if summary['groups']:
+            groups = f"{summary['groups']:,} group{'s' if summary['groups'] > 1 else ''}"
+            st.write(f"Duplicate values in {name}: {groups} with {summary['rows']:,} rows "
+                     f"({summary['rows'] / len(df):.1%} of all rows).")
+            sizes_column, groups_column = st.columns(2)
+            sizes_column.caption('Number of groups of every size')
+            sizes_column.bar_chart(summary['group_sizes'])
+            groups_column.caption('Largest groups')
+            groups_column.dataframe(summary['largest_groups'], hide_index=True)
+            if st.checkbox('Show the rows of the duplicate groups', key='duplicates_show_groups'):
+                page_count = -(-summary['groups'] // duplicate_groups_per_page)
+                if st.session_state.get('duplicates_page', 1) > page_count:
+                    st.session_state['duplicates_page'] = 1
+                page = st.number_input(f'Page (of {page_count:,})', min_value=1, max_value=page_count, key='duplicates_page')
+                first_group = (page - 1) * duplicate_groups_per_page
+                last_group = min(first_group + duplicate_groups_per_page, summary['groups'])
+                group_rows, _ = run_cleaning_stage(find_duplicate_groups, df, data_key, column_name, use_index, match,
+                                                   first_group, last_group)
+                st.caption(f"Groups {first_group + 1:,} to {last_group:,} of {summary['groups']:,}, the largest groups first")
+                st.dataframe(group_rows)
+            return f'Duplicate values in {name} found.'
+        return f'No duplicate values in {name} were found.'
 
 # Function to handle duplicates in a specified column or index
-def handle_duplicates_in_column_or_index(df, column_name, selected_action, use_index=False):
+def handle_duplicates_in_column_or_index(df, data_key, column_name, selected_action, use_index=False, match='exact'):
     handled_successfully = False  # Initialize a flag
 
     if df is not None and not df.empty:
-        if use_index:
-            if selected_action == 'Choose only the first value':
-                df = df.loc[~df.index.duplicated(keep='first')]
-                st.write('Only the first value in index kept.')
-                handled_successfully = True  # Set the flag to True
-            elif selected_action == 'Choose only the last value':
-                df = df.loc[~df.index.duplicated(keep='last')]
-                st.write('Only the last value in index kept.')
-                handled_successfully = True  # Set the flag to True
-            elif selected_action == 'Ignore':
-                st.write('No action taken for duplicates in index.')
-
+        name = describe_duplicate_key(column_name, use_index)
+        df, data_key = run_cleaning_stage(remove_duplicates, df, data_key, column_name, selected_action, use_index, match)
+        if selected_action == 'Take mean of duplicates':
+            st.write(f'Mean of duplicates in {name} taken.')
+        elif selected_action == 'Choose only the first value':
+            st.write(f'Only the first value in {name} kept.')
+        elif selected_action == 'Choose only the last value':
+            st.write(f'Only the last value in {name} kept.')
         else:
-            if selected_action == 'Take mean of duplicates':
-                # indicating duplicated values
-                duplicated_values = df[df[column_name].duplicated(keep=False)]
-                #creating a mask to stire index position
-                mask = df[column_name].duplicated(keep='first')
-                df = df[~mask]
-                # Now I will have to take the mean of the rows in duplicated vlaues, checking columns one by one for integer values
-
-                # Function to check if a column is numeric
-                def is_numeric(column):
-                    numeric_types = [int, float, np.number]
-                    return column.dtype in numeric_types
-                # Iterate through the columns in duplicated_values
-                for column in duplicated_values.columns:
-                    if is_numeric(duplicated_values[column]):
-                    # Calculate the mean for numeric columns and store it in the first row
-                        duplicated_values.at[0, column] = duplicated_values[column].mean()
-                else:
-                    # For non-numeric columns, keep the first occurrence
-                    duplicated_values[column] = duplicated_values[column].iloc[0]
-
-                # The result will be a row in duplicated_values with means for numeric columns and the first occurrence for non-numeric columns.
-
-                st.write(duplicated_values)
-                st.write(f'Mean of duplicates in column "{column_name}" taken.')
-                handled_successfully = True  # Set the flag to True
-            elif selected_action == 'Choose only the first value':
-                df = df[~df[column_name].duplicated(keep='first')]
-                st.write(f'Only the first value in column "{column_name}" kept.')
-                handled_successfully = True  # Set the flag to True
-            elif selected_action == 'Choose only the last value':
-                df = df[~df[column_name].duplicated(keep='last')]
-                st.write(f'Only the last value in column "{column_name}" kept.')
-                handled_successfully = True  # Set the flag to True
-            elif selected_action == 'Ignore':
-                st.write(f'No action taken for duplicates in column "{column_name}".')
-
-    return df, handled_successfully  # Return the DataFrame and the flag
+            st.write(f'No action taken for duplicates in {name}.')
+        handled_successfully = selected_action != 'Ignore'  # Set the flag when an action was taken
+
+    return df, data_key, handled_successfully  # Return the DataFrame, its key and the flag
 
 # User selection
 index_name = df.index.name if df.index.name else "[Index]"
 all_columns_plus_index = list(df.columns) + [index_name]
 
-selected_column_or_index = st.selectbox('Select a column or the index to check for duplicates:', all_columns_plus_index)
+selected_column_or_index = st.selectbox('Select a column or the index to check for duplicates:', all_columns_plus_index, key='duplicates_column')
 
 use_index = (selected_column_or_index == index_name)
+# Near-duplicates are found by a blocking key (the normalized value) instead of comparing all pairs of rows
+match_label = st.selectbox('Which values count as duplicates?', list(duplicate_match_labels), key='duplicates_match')
+duplicates_match = duplicate_match_labels[match_label]
 if use_index:
-    st.write(check_duplicates_in_column_or_index(df, None, use_index=True))
+    st.write(check_duplicates_in_column_or_index(df, data_key, None, use_index=True, match=duplicates_match))
 else:
-    st.write(check_duplicates_in_column_or_index(df, selected_column_or_index, use_index=False))
+    # More columns can be added to the key, rows are then duplicates when all of these columns are the same
+    key_columns = st.multiselect('Check together with these columns (for example gene, transcript and sample):',
+                                 [column for column in df.columns if column != selected_column_or_index],
+                                 key='duplicates_key_columns')
+    if key_columns:
+        selected_column_or_index = [selected_column_or_index] + key_columns
+    st.write(check_duplicates_in_column_or_index(df, data_key, selected_column_or_index, use_index=False, match=duplicates_match))
 
 # b. Handle duplicates
-if st.checkbox('Handle duplicates in this column or index'):
+if st.checkbox('Handle duplicates in this column or index', key='handle_duplicates'):
     if use_index:
         selected_action = st.selectbox(
             'How would you like to handle duplicates in the index?',
-            ('Choose only the first value', 'Choose only the last value', 'Ignore')
+            ('Choose only the first value', 'Choose only the last value', 'Ignore'), key='index_duplicates_action'
         )
     else:
         selected_action = st.selectbox(
-            f'How would you like to handle duplicates in column "{selected_column_or_index}"?',
-            ('Take mean of duplicates', 'Choose only the first value', 'Choose only the last value', 'Ignore')
+            f'How would you like to handle duplicates in {describe_duplicate_key(selected_column_or_index)}?',
+            duplicate_actions, key='duplicates_action'
         )
-    df, handled_successfully = handle_duplicates_in_column_or_index(df, selected_column_or_index, selected_action, use_index)
+    df, data_key, handled_successfully = handle_duplicates_in_column_or_index(df, data_key, selected_column_or_index, selected_action, use_index, duplicates_match)
+    cleaning_steps.append({'step': 'duplicates', 'column': selected_column_or_index, 'action': selected_action, 'use_index': use_index})
+    if duplicates_match != 'exact':
+        cleaning_steps[-1]['match'] = duplicates_match
     if handled_successfully:
         st.subheader("Cleaned DataFrame:")
         st.dataframe(df)
@@ -208,25 +718,31 @@ if st.checkbox('Handle duplicates in this column or index'):
 st.markdown('<a name="manage-missing"></a>', unsafe_allow_html=True)  # Create an anchor for this section
 st.subheader('3. Managing missing values')
 
-def handle_missing_values(df):
-    missing_rows = df[df.isnull().any(axis=1)]
+def handle_missing_values(df, data_key):
+    missing_rows, _ = run_cleaning_stage(find_rows_with_missing_values, df, data_key)
     if not missing_rows.empty:
         st.write("Rows with missing values:")
         st.dataframe(missing_rows)
         
         # Add options for the user
         st.subheader("Options:")
-        option = st.radio("Select an action:", ("Delete Rows with Missing Values", "Fill Missing Values"))
+        option = st.radio("Select an action:", ("Delete Rows with Missing Values", "Fill Missing Values"), key='missing_action')
         
         if option == "Delete Rows with Missing Values":
-            df = df.dropna(axis=0, how = 'any')
+            df, data_key = run_cleaning_stage(remove_rows_with_missing_values, df, data_key)
             st.write("Rows with missing values deleted.")
+            cleaning_steps.append({'step': 'missing', 'action': 'delete'})
         else:
             # Allow the user to specify a value for filling missing values
-            fill_value = st.text_input("Enter a value to fill missing values:")
+            fill_value = st.text_input("Enter a value to fill missing values:", key='fill_value')
+            # The value is kept in the session state once the button is clicked, so the filling stays applied
             if st.button("Fill Missing Values"):
-                df = df.fillna(fill_value)
-                st.write("Missing values filled with the specified value.")
+                st.session_state['applied_fill_value'] = fill_value
+            if st.session_state.get('applied_fill_value') is not None:
+                applied_fill_value = st.session_state['applied_fill_value']
+                df, data_key = run_cleaning_stage(fill_missing_values, df, data_key, applied_fill_value)
+                st.write(f"Missing values filled with {applied_fill_value!r}.")
+                cleaning_steps.append({'step': 'missing', 'action': 'fill', 'value': applied_fill_value})
 
         # Display the cleaned DataFrame (either with deleted rows or filled values)
         st.subheader("Cleaned DataFrame:")
@@ -234,10 +750,10 @@ def handle_missing_values(df):
     else:
         st.write("No rows with missing values found.")
         
-    return df
+    return df, data_key
 
 # call the function
-df = handle_missing_values(df)
+df, data_key = handle_missing_values(df, data_key)
 
 
 
@@ -245,32 +761,31 @@ df = handle_missing_values(df)
 st.markdown('<a name="convert-int-to-decimal"></a>', unsafe_allow_html=True)  # Create an anchor for this section
 st.subheader('4. Data type converter')
 
-selected_option_convert = st.selectbox("Would you like to convert data types in your file?", ["NO", "YES"])
+selected_option_convert = st.selectbox("Would you like to convert data types in your file?", ["NO", "YES"], key='convert')
 
 if selected_option_convert == "YES":
-    selected_conversion_type = st.selectbox("What conversion type would you like to perform?", ["Convert to Integers", "Convert to Floats", "Convert to Strings"])
-    columns_to_convert = st.multiselect("Select the columns to convert:", df.columns)
+    selected_conversion_type = st.selectbox("What conversion type would you like to perform?", ["Convert to Integers", "Convert to Floats", "Convert to Strings"], key='conversion_type')
+    columns_to_convert = st.multiselect("Select the columns to convert:", df.columns, key='convert_columns')
 
     if columns_to_convert:
-        if selected_conversion_type == "Convert to Floats":
-            df[columns_to_convert] = df[columns_to_convert].astype(float)
-
-        elif selected_conversion_type == "Convert to Integers":
-            # Check for NaN or infinite values in the columns
-            if df[columns_to_convert].isnull().any().any() or np.isinf(df[columns_to_convert]).any().any():
-                action = st.radio("NaN or infinite values detected. How would you like to handle them?",
-                                  ["Replace with specific value", "Drop rows containing NaN or inf", "Do nothing"])
-                if action == "Replace with specific value":
-                    replace_val = st.number_input("Enter the value to replace NaN or infinite values with:", value=0)
-                    df[columns_to_convert] = df[columns_to_convert].fillna(replace_val).replace([np.inf, -np.inf], replace_val)
-                elif action == "Drop rows containing NaN or inf":
-                    df.dropna(subset=columns_to_convert, inplace=True)
-                    df = df[~np.isinf(df[columns_to_convert]).any(axis=1)]
-            df[columns_to_convert] = df[columns_to_convert].astype(int)
-
-        elif selected_conversion_type == "Convert to Strings":
-            df[columns_to_convert] = df[columns_to_convert].astype(str)
-
+        convert_step = {'step': 'convert', 'type': selected_conversion_type, 'columns': list(columns_to_convert)}
+        # Check for NaN or infinite values in the columns, these cannot be converted to integers
+        if selected_conversion_type == "Convert to Integers" and has_non_finite_values(df, columns_to_convert):
+            action = st.radio("NaN or infinite values detected. How would you like to handle them?",
+                              ["Replace with specific value", "Drop rows containing NaN or inf", "Do nothing"], key='non_finite_action')
+            if action == "Replace with specific value":
+                replace_val = st.number_input("Enter the value to replace NaN or infinite values with:", value=0, key='replace_value')
+                convert_step.update({'non_finite': 'replace', 'replace_value': replace_val})
+            elif action == "Drop rows containing NaN or inf":
+                convert_step['non_finite'] = 'drop'
+        try:
+            df, data_key = run_cleaning_stage(convert_columns, df, data_key, list(columns_to_convert), selected_conversion_type,
+                                              convert_step.get('non_finite'), convert_step.get('replace_value', 0))
+        except ValueError as error:
+            st.error(f'The selected columns could not be converted: {error}')
+            st.stop()
+
+        cleaning_steps.append(convert_step)
         st.write(df)
     else:
         st.write("Please select the columns you wish to convert.")
@@ -285,119 +800,231 @@ st.markdown('<a name="split-concatenate-columns"></a>', unsafe_allow_html=True)
 st.subheader('5. Split or concatenate columns')
 
 # Code for splitting or concatenating columns
+# The steps of this section are only recorded here, the previews are made from the first rows of the data.
+# The whole result is made once, when the file is downloaded, as one new DataFrame (see plan_cleaning_steps)
+preview_rows = 1000
+preview_df = df.head(preview_rows)
+column_steps = []
 
-selected_option_splitconcat = st.selectbox("Would you like to split or concatenate columns in your file?", ["NO", "YES"])
+selected_option_splitconcat = st.selectbox("Would you like to split or concatenate columns in your file?", ["NO", "YES"], key='split_concat')
 
 if selected_option_splitconcat == "YES":
 
     st.subheader('Options:')
-    operation = st.radio("Select an action:", ("Split", "Concatenate", "Both"))
+    operation = st.radio("Select an action:", ("Split", "Concatenate", "Both"), key='split_concat_operation')
+    if len(df) > preview_rows:
+        st.write(f"The previews below show the first {preview_rows} rows of your file.")
 
-    if operation == "Split":
+    if operation in ("Split", "Both"):
             # Split columns
         st.subheader("Split Columns")
-        column_to_split = st.selectbox("Select the column to split:", df.columns)
-        separator = st.text_input("Separator for splitting:", ",")
-
-            # Ensure the selected column is treated as a string before splitting
-        split_values = df[column_to_split].astype(str).str.split(separator, expand=True)
+        column_to_split = st.selectbox("Select the column to split:", df.columns, key='split_column')
+        separator = st.text_input("Separator for splitting:", ",", key='split_separator')
 
-            # Label the split columns with the original column name
-        split_values.columns = [f"{column_to_split}_{i + 1}" for i in range(split_values.shape[1])]
+            # Split the column (as strings) into new columns labelled with the original column name
+            # Every row is split into as many columns as the row with the most parts
+        split_parts, _ = run_cleaning_stage(count_split_parts, df, data_key, column_to_split, separator)
+        column_steps.append({'step': 'split', 'column': column_to_split, 'separator': separator, 'parts': split_parts})
 
             # Display the split values along with the original dataset
-        st.write(split_values)
+        merged_preview = clean_dataframe(preview_df, column_steps)
+        st.write(merged_preview[get_split_column_names(column_to_split, split_parts)])
         st.write("Merged Dataset with Split Columns")
-        merged_df = pd.concat([df, split_values], axis=1)
-        st.write(merged_df)
+        st.write(merged_preview)
 
-    elif operation == "Concatenate":
+    if operation in ("Concatenate", "Both"):
             # Concatenate columns
         st.subheader("Concatenate Columns")
         st.write("Select the columns to concatenate:")
-        concat_columns = st.multiselect("Columns to concatenate:", df.columns)
-        separator = st.text_input("Separator for concatenation:", " ")
-        concat_df = df[concat_columns].astype(str).agg(separator.join, axis=1)
+        concat_options = merged_preview.columns if operation == "Both" else df.columns
+        concat_columns = st.multiselect("Columns to concatenate:", concat_options, key='concat_columns')
+        separator = st.text_input("Separator for concatenation:", " ", key='concat_separator')
+        column_steps.append({'step': 'concat', 'columns': list(concat_columns), 'separator': separator, 'name': 'Concatenated_Column'})
 
             # Display the concatenated values along with the original dataset
+        merged_preview = clean_dataframe(preview_df, column_steps)
         st.write("Concatenated Values")
-        st.write(concat_df)
+        st.write(merged_preview['Concatenated_Column'])
         st.write("Merged Dataset with Concatenated Column")
-        merged_df = pd.concat([df, concat_df.rename("Concatenated_Column")], axis=1)
-        st.write(merged_df)
-        
-    else:
-            # Do both
-        st.subheader("Split Columns")
-        column_to_split = st.selectbox("Select the column to split:", df.columns)
-        separator = st.text_input("Separator for splitting:", ",")
-
-            # Ensure the selected column is treated as a string before splitting
-        split_values = df[column_to_split].astype(str).str.split(separator, expand=True)
-
-            # Label the split columns with the original column name
-        split_values.columns = [f"{column_to_split}_{i + 1}" for i in range(split_values.shape[1])]
-
-            # Display the split values along with the original dataset
-        st.write(split_values)
-        st.write("Merged Dataset with Split Columns")
-        merged_df_split = pd.concat([df, split_values], axis=1)
-        st.write(merged_df_split)
-        
-        # Concatenate columns
-        st.subheader("Concatenate Columns")
-        st.write("Select the columns to concatenate:")
-        concat_columns = st.multiselect("Columns to concatenate:", merged_df_split.columns)
-        separator = st.text_input("Separator for concatenation:", " ")
-        concat_df = merged_df_split[concat_columns].astype(str).agg(separator.join, axis=1)
-
-            # Display the concatenated values along with the original dataset
-        st.write("Concatenated Values")
-        st.write(concat_df)
-        st.write("Merged Dataset with Concatenated Column")
-        merged_df = pd.concat([merged_df_split, concat_df.rename("Concatenated_Column")], axis=1)
-        st.write(merged_df)
+        st.write(merged_preview)
 
         # Set the value of the action variable
-    action = st.radio("Choose action:", ("Keep Selected Columns", "Delete Selected Columns"))
+    action = st.radio("Choose action:", ("Keep Selected Columns", "Delete Selected Columns"), key='columns_action')
     
         # Continue with the action based on the user's choice
     if action == "Keep Selected Columns":
-        columns_to_keep = st.multiselect("Please select all columns to keep:", merged_df.columns)
-        result_df = merged_df[columns_to_keep]
+        columns_to_keep = st.multiselect("Please select all columns to keep:", merged_preview.columns, key='columns_to_keep')
+        column_steps.append({'step': 'keep_columns', 'columns': list(columns_to_keep)})
     else:
-        columns_to_delete = st.multiselect("Please select all columns to delete:", merged_df.columns)
-        result_df = merged_df.drop(columns=columns_to_delete)
-
+        columns_to_delete = st.multiselect("Please select all columns to delete:", merged_preview.columns, key='columns_to_delete')
+        column_steps.append({'step': 'delete_columns', 'columns': list(columns_to_delete)})
 
     # Display the resulting dataset
-        st.subheader("Resulting Dataset")
-        st.write(result_df)
+    st.subheader("Resulting Dataset")
+    st.write(clean_dataframe(preview_df, column_steps))
 
 else:
     st.write("We will NOT be splitting or concatenating columns in your file.")
-    result_df = df
+
+cleaning_steps.extend(column_steps)
+
+# Undo and redo of the cleaning steps, at the bottom of the sidebar
+record_version(source_key, cleaning_steps)
+history = get_history()
+position = history['position']
+st.sidebar.subheader('Cleaning history')
+st.sidebar.write(f"Version {position + 1} of {len(history['versions'])} ({len(cleaning_steps)} cleaning steps)")
+undo_column, redo_column = st.sidebar.columns(2)
+if position > 0:
+    previous_steps = history['versions'][position - 1]['steps']
+    undo_help = 'Back to: ' + (', '.join(describe_step(step) for step in previous_steps) or 'no cleaning steps')
+    undo_column.button('Undo', help=undo_help, on_click=restore_version, args=(position - 1,))
+if position < len(history['versions']) - 1:
+    next_steps = history['versions'][position + 1]['steps']
+    redo_help = 'Forward to: ' + (', '.join(describe_step(step) for step in next_steps) or 'no cleaning steps')
+    redo_column.button('Redo', help=redo_help, on_click=restore_version, args=(position + 1,))
     
 
 # Section 7: Conclusion , retieving the data from the webtool
 
-# Function to create a download link for the processed data
-
-def get_binary_file_downloader_html(df):
-
-    # Create a BytesIO object to store the Excel file
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=True)
-    
-    b64 = base64.b64encode(output.getvalue()).decode()
-    href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="cleaned_data.xlsx">Download Excel File</a>'
-    return href
+# Functions to build the file with the processed data when the user clicks the button
+# The file is written to disk in the background, a block of rows at a time, and kept there until the data or the steps change
+
+# Function to get the path of the download file for the data and the cleaning steps
+def get_download_path(data_key, steps, extension):
+    download_key = hashlib.blake2b(repr((data_key, steps)).encode(), digest_size=16).hexdigest()
+    return os.path.join(staging_folder, f'download_{download_key}.{extension}')
+
+# Function to write the download file for a DataFrame cleaned with the steps of section 6
+# The file is written to a temporary name first, so a half written (or cancelled) file is never downloaded
+def write_cleaned_file(df, steps, file_format, path, progress=None):
+    prepare_staging_folder()
+    part_file, part_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1], dir=staging_folder)
+    os.close(part_file)
+    try:
+        write_download_file(clean_dataframe(df, steps), part_path, file_format, progress)
+    except BaseException:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, path)
+    return path
+
+# Function to clean the whole file chunk by chunk (streaming mode) and write it to the download file
+def write_cleaned_chunks(open_chunks, steps, path, progress=None):
+    prepare_staging_folder()
+    os.replace(clean_file_in_chunks(open_chunks, steps, staging_folder, progress), path)
+    return path
 
 st.subheader('All done!!')
 st.write('Your datafile has been cleaned')
-st.write("You can download the processed data as an Excel file.")
-st.markdown(get_binary_file_downloader_html(result_df), unsafe_allow_html=True)
+if streaming_mode:
+    st.write("Your file is cleaned chunk by chunk when you click the button below and downloaded as a CSV file.")
+    # The whole file is only cleaned when the button is clicked (in the background, with a progress bar)
+    open_upload_chunks = lambda: read_in_chunks(upload, file_sep, chunk_size, csv_schema['encoding'], csv_schema['dtype'])
+    download_path = get_download_path(data_key, cleaning_steps, 'csv')
+    if not os.path.exists(download_path) and (st.button('Clean the whole file') or has_background_task('download', download_path)):
+        run_in_background('download', download_path, 'Cleaning your file', write_cleaned_chunks,
+                          open_upload_chunks, cleaning_steps, download_path, report_progress=True)
+    if os.path.exists(download_path):
+        st.download_button('Download CSV File', lambda: open(download_path, 'rb'),
+                           file_name='cleaned_data.csv', mime='text/csv', on_click='ignore')
+else:
+    st.write("You can download the processed data as an Excel, CSV, Parquet or Feather file.")
+    download_options = list(download_formats) if pa is not None else ['Excel', 'CSV']
+    download_format = st.selectbox('Please choose the file format to download:', download_options)
+    # The file is only built when the button is clicked, not on every rerun of the page
+    extension, mime_type = download_formats[download_format]
+    download_path = get_download_path(data_key, column_steps, extension)
+    if not os.path.exists(download_path) and (st.button(f'Prepare {download_format} File') or has_background_task('download', download_path)):
+        run_in_background('download', download_path, f'Writing your {download_format} file', write_cleaned_file,
+                          df, column_steps, download_format, download_path, report_progress=True)
+    if os.path.exists(download_path):
+        st.download_button(f'Download {download_format} File', lambda: open(download_path, 'rb'),
+                           file_name=f'cleaned_data.{extension}', mime=mime_type, on_click='ignore')
+
+# The cleaning steps chosen above can be saved as a recipe, to clean other files the same way in the batch mode or with cleaning_cli.py
+st.write("You can also save the cleaning steps you chose as a recipe, to clean other files the same way in the batch mode below or on the command line.")
+recipe_options = list(recipe_formats) if yaml is not None else ['JSON']
+recipe_format = st.selectbox('Please choose the file format of the recipe:', recipe_options)
+with st.expander('Show the cleaning steps'):
+    st.json(cleaning_steps)
+st.download_button(f'Download {recipe_format} recipe', dump_recipe(cleaning_steps, recipe_format),
+                   file_name=f'cleaning_recipe.{recipe_formats[recipe_format]}', mime='text/plain', on_click='ignore')
+
+
+# Section 7b: Batch mode, clean many files with the same cleaning steps
+st.markdown('<a name="batch-mode"></a>', unsafe_allow_html=True)  # Create an anchor for this section
+st.subheader('6. Batch mode: clean many files at once')
+st.write('The cleaning steps you chose above (or the steps of a saved recipe) are applied to every file you upload here. The files are cleaned in parallel (one file per CPU core) and you get all cleaned files back in one zip archive.')
+
+# Function to clean many files in parallel worker processes and put the cleaned files in a zip archive
+# The workers are started with 'spawn', which is safe in the multithreaded Streamlit server
+# It runs in the background: progress is called with the fraction of files cleaned and stops the batch when it is cancelled
+def clean_files_in_batch(batch_uploads, file_format, steps, output_format, progress=None):
+    prepare_staging_folder()
+    output_folder = tempfile.mkdtemp(prefix=batch_folder_prefix, dir=staging_folder)
+    archive_path = output_folder + '.zip'
+    errors = []
+    # Files with the same name get a number, so their cleaned files do not overwrite each other
+    file_names = []
+    for batch_upload in batch_uploads:
+        file_name = batch_upload.name
+        if file_name in file_names:
+            file_name = f'{len(file_names) + 1}_{file_name}'
+        file_names.append(file_name)
+    max_workers = min(os.cpu_count() or 1, len(batch_uploads))
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(clean_batch_file, file_name, batch_upload.getvalue(), file_format, steps, output_format, output_folder)
+                   for file_name, batch_upload in zip(file_names, batch_uploads)]
+        try:
+            with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    file_name, output_name, error = future.result()
+                    if error is None:
+                        archive.write(os.path.join(output_folder, output_name), output_name)
+                    else:
+                        errors.append(f'{file_name} could not be cleaned: {error}')
+                    if progress is not None:
+                        progress(done / len(futures))
+        except BaseException:
+            # The files that were not started yet are not cleaned any more
+            executor.shutdown(cancel_futures=True)
+            shutil.rmtree(output_folder, ignore_errors=True)
+            os.remove(archive_path)
+            raise
+    shutil.rmtree(output_folder, ignore_errors=True)
+    return archive_path, errors
+
+batch_steps_source = st.radio('Which cleaning steps should be used?', ('The steps chosen above', 'A saved recipe'), key='batch_steps_source')
+batch_steps = cleaning_steps
+if batch_steps_source == 'A saved recipe':
+    recipe_upload = st.file_uploader('Upload your recipe here', type=['json', 'yaml', 'yml'], key='batch_recipe')
+    if recipe_upload is None:
+        batch_steps = None
+    else:
+        try:
+            batch_steps = load_recipe(recipe_upload.getvalue())
+            st.write(f'The recipe has {len(batch_steps)} cleaning steps.')
+        except ValueError as error:
+            st.error(f'The recipe could not be read: {error}')
+            batch_steps = None
+
+batch_format = st.selectbox('Please choose the file format of the files you are uploading:', ('CSV', 'TSV', 'Excel', 'Parquet', 'Feather'), key='batch_format')
+batch_uploads = st.file_uploader('Upload your files here', accept_multiple_files=True, key='batch_upload')
+batch_output_format = st.selectbox('Please choose the file format of the cleaned files:', list(download_formats) if pa is not None else ['Excel', 'CSV'], key='batch_output_format')
+
+if batch_uploads and batch_steps is not None:
+    batch_key = repr(([batch_upload.file_id for batch_upload in batch_uploads], batch_format, batch_steps, batch_output_format))
+    if st.button('Clean all files') or has_background_task('batch', batch_key):
+        archive_path, batch_errors = run_in_background('batch', batch_key, f'Cleaning {len(batch_uploads)} files', clean_files_in_batch,
+                                                       batch_uploads, batch_format, batch_steps, batch_output_format, report_progress=True)
+        for batch_error in batch_errors:
+            st.warning(batch_error)
+        st.session_state['batch_archive'] = archive_path
+    if st.session_state.get('batch_archive') and os.path.exists(st.session_state['batch_archive']):
+        batch_archive = st.session_state['batch_archive']
+        st.download_button('Download the cleaned files (zip)', lambda: open(batch_archive, 'rb'),
+                           file_name='cleaned_files.zip', mime='application/zip', on_click='ignore')
 
 
 # Section 8: Convert dates to gene names
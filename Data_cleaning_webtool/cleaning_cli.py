@@ -0,0 +1,198 @@
+# Command line version of the data cleaning webtool
+# Runs the same cleaning steps as the webtool on one or more files, without a browser, for example:
+#   python cleaning_cli.py results_*.csv --duplicates "Gene names" --duplicates-action first --missing delete
+# or with a recipe saved in the webtool:
+#   python cleaning_cli.py results_*.csv --recipe cleaning_recipe.json
+# Large CSV/TSV files can be cleaned a chunk of rows at a time with --chunk-size, the result is then a CSV file
+# Files larger than memory can be cleaned with --backend duckdb, which spills to disk (see cleaning_duckdb.py)
+
+import argparse
+import os
+import shutil
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from cleaning_engine import (zstandard, detect_compression, get_zip_members, open_compressed_upload, sniff_csv_schema,
+                             read_in_chunks, download_formats, duplicate_action_names, duplicate_matches,
+                             conversion_type_names, non_finite_actions, guess_input_format, get_cleaned_file_name, clean_file_in_chunks,
+                             dump_recipe, load_recipe, clean_batch_file)
+from cleaning_duckdb import duckdb, duckdb_input_formats, duckdb_output_formats, clean_file_with_duckdb
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Clean data files with the same steps as the data cleaning webtool.')
+    parser.add_argument('files', nargs='*', help='the files to clean')
+    parser.add_argument('--recipe', help='recipe (JSON or YAML) with the cleaning steps, the options below are added after it')
+    parser.add_argument('--save-recipe', metavar='FILE', help='save the cleaning steps as a recipe (.json, .yaml or .yml)')
+    parser.add_argument('--format', choices=('Excel', 'CSV', 'TSV', 'Parquet', 'Feather'),
+                        help='file format of the input files (default: guessed from the file extension)')
+    parser.add_argument('--output-dir', default='.', help='folder for the cleaned files (default: current folder)')
+    parser.add_argument('--output-format', choices=list(download_formats), default='CSV',
+                        help='file format of the cleaned files (default: CSV)')
+    parser.add_argument('--duplicates', nargs='+', metavar='COLUMN',
+                        help='column to check for duplicates, several columns are checked together as one key')
+    parser.add_argument('--index-duplicates', action='store_true', help='check the index for duplicates instead')
+    parser.add_argument('--duplicates-action', choices=list(duplicate_action_names), default='first',
+                        help='how to handle duplicates (default: first)')
+    parser.add_argument('--duplicates-match', choices=duplicate_matches, default='exact',
+                        help='match the keys exactly (default), normalized (no case, spaces or version suffix) '
+                             'or similar (normalized and small typos)')
+    parser.add_argument('--missing', choices=('delete', 'fill'), help='delete or fill rows with missing values')
+    parser.add_argument('--fill-value', default='', help='value for filling missing values')
+    parser.add_argument('--convert', choices=list(conversion_type_names), help='data type to convert columns to')
+    parser.add_argument('--convert-columns', nargs='+', metavar='COLUMN', help='the columns to convert')
+    parser.add_argument('--non-finite', choices=non_finite_actions,
+                        help='what to do with NaN or infinite values when converting to integers')
+    parser.add_argument('--replace-value', type=float, default=0, help='value for NaN or infinite values (default: 0)')
+    parser.add_argument('--split', metavar='COLUMN', help='column to split into new columns')
+    parser.add_argument('--split-separator', default=',', help='separator for splitting (default: ",")')
+    parser.add_argument('--split-parts', type=int, help='number of columns to split into (needed with --chunk-size)')
+    parser.add_argument('--concat', nargs='+', metavar='COLUMN', help='columns to concatenate into a new column')
+    parser.add_argument('--concat-separator', default=' ', help='separator for concatenation (default: " ")')
+    parser.add_argument('--concat-name', default='Concatenated_Column', help='name of the concatenated column')
+    columns = parser.add_mutually_exclusive_group()
+    columns.add_argument('--keep', nargs='+', metavar='COLUMN', help='keep only these columns')
+    columns.add_argument('--delete', nargs='+', metavar='COLUMN', help='delete these columns')
+    parser.add_argument('--chunk-size', type=int, help='clean CSV/TSV files this many rows at a time')
+    parser.add_argument('--backend', choices=('pandas', 'duckdb'), default='pandas',
+                        help='pandas (default) or duckdb, which cleans files larger than memory by spilling to disk')
+    parser.add_argument('--memory-limit', help='memory the duckdb backend may use, for example 4GB')
+    parser.add_argument('--jobs', type=int, default=1, help='number of files to clean at the same time (default: 1)')
+    return parser
+
+# Function to turn the command line arguments into the cleaning steps recorded by the webtool, in the same order
+def build_steps(args):
+    steps = []
+    if args.duplicates or args.index_duplicates:
+        # One column is recorded as a name, like in the webtool, several columns as a list
+        column = args.duplicates[0] if args.duplicates and len(args.duplicates) == 1 else args.duplicates
+        steps.append({'step': 'duplicates', 'column': column, 'use_index': args.index_duplicates,
+                      'action': duplicate_action_names[args.duplicates_action]})
+        if args.duplicates_match != 'exact':
+            steps[-1]['match'] = args.duplicates_match
+    if args.missing == 'delete':
+        steps.append({'step': 'missing', 'action': 'delete'})
+    elif args.missing == 'fill':
+        steps.append({'step': 'missing', 'action': 'fill', 'value': args.fill_value})
+    if args.convert:
+        convert_step = {'step': 'convert', 'type': conversion_type_names[args.convert], 'columns': args.convert_columns}
+        if args.non_finite:
+            convert_step.update({'non_finite': args.non_finite, 'replace_value': args.replace_value})
+        steps.append(convert_step)
+    if args.split:
+        steps.append({'step': 'split', 'column': args.split, 'separator': args.split_separator, 'parts': args.split_parts})
+    if args.concat:
+        steps.append({'step': 'concat', 'columns': args.concat, 'separator': args.concat_separator,
+                      'name': args.concat_name})
+    if args.keep:
+        steps.append({'step': 'keep_columns', 'columns': args.keep})
+    elif args.delete:
+        steps.append({'step': 'delete_columns', 'columns': args.delete})
+    return steps
+
+# Function to clean one file a chunk of rows at a time, the result is always a CSV file
+def clean_file_with_chunks(file_name, file_format, steps, chunk_size, output_folder):
+    try:
+        with open(file_name, 'rb') as file:
+            compression = detect_compression(file, file_format)
+            member = get_zip_members(file)[0] if compression == 'zip' else None
+
+        # Every pass over the file opens it again
+        def open_file():
+            upload = open(file_name, 'rb')
+            if compression is None:
+                return upload
+            return open_compressed_upload(upload, file_format, compression, member)
+
+        csv_schema = sniff_csv_schema(open_file(), ',' if file_format == 'CSV' else '\t')
+        open_chunks = lambda: read_in_chunks(open_file(), csv_schema['sep'], chunk_size,
+                                             csv_schema['encoding'], csv_schema['dtype'])
+        output_name = get_cleaned_file_name(file_name, 'CSV')
+        shutil.move(clean_file_in_chunks(open_chunks, steps, output_folder), os.path.join(output_folder, output_name))
+        return file_name, output_name, None
+    except Exception as error:
+        return file_name, None, f'{type(error).__name__}: {error}'
+
+# Function to clean one file with the duckdb backend
+def clean_file_out_of_core(file_name, file_format, steps, output_format, memory_limit, output_folder):
+    try:
+        output_name = get_cleaned_file_name(file_name, output_format)
+        clean_file_with_duckdb(file_name, file_format, steps, os.path.join(output_folder, output_name), output_format, memory_limit)
+        return file_name, output_name, None
+    except Exception as error:
+        return file_name, None, f'{type(error).__name__}: {error}'
+
+# Function to clean one input file, it runs in a worker process when more than one job is used
+def clean_input_file(file_name, file_format, steps, output_format, chunk_size, output_folder, backend='pandas', memory_limit=None):
+    if backend == 'duckdb':
+        return clean_file_out_of_core(file_name, file_format, steps, output_format, memory_limit, output_folder)
+    if chunk_size:
+        return clean_file_with_chunks(file_name, file_format, steps, chunk_size, output_folder)
+    return clean_batch_file(file_name, None, file_format, steps, output_format, output_folder)
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.convert and not args.convert_columns:
+        parser.error('--convert needs --convert-columns')
+    if args.split and args.chunk_size and not args.split_parts:
+        parser.error('--split with --chunk-size needs --split-parts, so every chunk gets the same columns')
+    if not args.files and not args.save_recipe:
+        parser.error('no files to clean')
+    if args.backend == 'duckdb':
+        if duckdb is None:
+            parser.error('the duckdb backend needs the duckdb package (pip install duckdb)')
+        if args.output_format not in duckdb_output_formats:
+            parser.error(f'the duckdb backend writes {" or ".join(duckdb_output_formats)} files')
+        if args.duplicates_match == 'similar':
+            parser.error('the duckdb backend cannot find similar keys, use --duplicates-match normalized')
+
+    steps = []
+    if args.recipe:
+        try:
+            with open(args.recipe, 'rb') as recipe_file:
+                steps = load_recipe(recipe_file.read())
+        except (OSError, ValueError) as error:
+            parser.error(f'cannot read the recipe: {error}')
+    steps += build_steps(args)
+    if args.save_recipe:
+        recipe_format = 'YAML' if args.save_recipe.endswith(('.yaml', '.yml')) else 'JSON'
+        with open(args.save_recipe, 'w', encoding='utf-8') as recipe_file:
+            recipe_file.write(dump_recipe(steps, recipe_format))
+
+    jobs = []
+    for file_name in args.files:
+        file_format = args.format or guess_input_format(file_name)
+        if file_format is None:
+            parser.error(f'cannot guess the file format of {file_name}, use --format')
+        if args.chunk_size and file_format not in ('CSV', 'TSV'):
+            parser.error('--chunk-size only works for CSV and TSV files')
+        if args.backend == 'duckdb' and (file_format not in duckdb_input_formats or file_name.endswith(('.bz2', '.zip'))):
+            parser.error(f'the duckdb backend reads {", ".join(duckdb_input_formats)} files (plain, .gz or .zst)')
+        if file_name.endswith('.zst') and zstandard is None and args.backend == 'pandas':
+            parser.error('zstd files need the zstandard package (pip install zstandard)')
+        jobs.append((file_name, file_format))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(clean_input_file, *zip(*[(file_name, file_format, steps, args.output_format,
+                                                              args.chunk_size, args.output_dir, args.backend,
+                                                              args.memory_limit)
+                                                             for file_name, file_format in jobs])))
+    else:
+        results = [clean_input_file(file_name, file_format, steps, args.output_format, args.chunk_size, args.output_dir,
+                                    args.backend, args.memory_limit)
+                   for file_name, file_format in jobs]
+
+    failed = 0
+    for file_name, output_name, error in results:
+        if error is None:
+            print(f'{file_name} -> {os.path.join(args.output_dir, output_name)}')
+        else:
+            print(f'{file_name}: {error}', file=sys.stderr)
+            failed += 1
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# Out-of-core backend of the data cleaning webtool
+# The recorded cleaning steps are translated to one SQL query that DuckDB runs on the file. DuckDB spills to disk
+# when the data does not fit in memory, so files much larger than the memory of the computer can be cleaned.
+# It is used by cleaning_cli.py with --backend duckdb and gives the same result as the pandas functions in
+# cleaning_engine.py. As in the webtool, the first column of the file is the index.
+import os
+import tempfile
+
+from cleaning_engine import (pa, get_arrow_schema, get_arrow_index_columns, get_split_column_names, get_key_columns,
+                             version_suffix_pattern)
+
+# DuckDB is optional, the pandas backend works without it
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# File formats DuckDB can read and write (.gz and .zst compressed CSV/TSV files are read as well)
+duckdb_input_formats = ('CSV', 'TSV', 'Parquet')
+duckdb_output_formats = ('CSV', 'Parquet')
+
+# Name of the column with the row number in the file, it keeps the rows in their original order
+row_number_column = '__row_number'
+
+numeric_types = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'UTINYINT', 'USMALLINT', 'UINTEGER',
+                 'UBIGINT', 'FLOAT', 'DOUBLE')
+
+# Functions to write SQL
+def quote_name(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def quote_text(text):
+    return "'" + str(text).replace("'", "''") + "'"
+
+# Function to check if a column type is numeric (decimals included)
+def is_numeric_type(column_type):
+    column_type = str(column_type)
+    return column_type in numeric_types or column_type.startswith('DECIMAL')
+
+# Function to check if a column type is a floating point type, which can hold NaN and infinite values
+def is_float_type(column_type):
+    return str(column_type) in ('FLOAT', 'DOUBLE')
+
+# Function to get the SQL that reads the file, CSV/TSV files are read with the types detected by DuckDB
+# pandas stores the index of a DataFrame as the last column of a Parquet file, it is moved to the front
+def get_read_sql(path, file_format):
+    if file_format == 'Parquet':
+        index_columns = []
+        if pa is not None:
+            with open(path, 'rb') as file:
+                index_columns = get_arrow_index_columns(get_arrow_schema(file, file_format))
+        if index_columns:
+            index_column = quote_name(index_columns[0])
+            return f'SELECT {index_column}, * EXCLUDE ({index_column}) FROM read_parquet({quote_text(path)})'
+        return f'SELECT * FROM read_parquet({quote_text(path)})'
+    delimiter = ',' if file_format == 'CSV' else '\t'
+    return f'SELECT * FROM read_csv({quote_text(path)}, header = true, delim = {quote_text(delimiter)})'
+
+# Functions to translate one cleaning step to SQL
+# Every function gets the query of the data before the step and its columns (name: type), and returns the new query
+# Function to get the SQL of a duplicate key column, text keys are normalized as in normalize_keys
+def duplicate_key_sql(name, column_type, match):
+    if match == 'exact' or str(column_type) != 'VARCHAR':
+        return quote_name(name)
+    normalized = f"regexp_replace(lower({quote_name(name)}), '\\s+', '', 'g')"
+    return f"regexp_replace({normalized}, {quote_text(version_suffix_pattern)}, '')"
+
+def duplicates_sql(query, columns, step, index_column):
+    key_columns = [index_column] if step['use_index'] else get_key_columns(step['column'])
+    match = step.get('match', 'exact')
+    if match == 'similar':
+        raise ValueError('The duckdb backend cannot find similar keys, use normalized keys or the pandas backend')
+    key = ', '.join(duplicate_key_sql(name, columns[name], match) for name in key_columns)
+    action = step['action']
+    if action == 'Ignore':
+        return query
+    order = 'DESC' if action == 'Choose only the last value' else 'ASC'
+    keep_one_row = f'QUALIFY row_number() OVER (PARTITION BY {key} ORDER BY {row_number_column} {order}) = 1'
+    if action != 'Take mean of duplicates':
+        return f'SELECT * FROM ({query}) {keep_one_row}'
+    # The numeric columns get the mean of all rows with the same key, the other columns keep the first value
+    mean_columns = [name for name, column_type in columns.items()
+                    if is_numeric_type(column_type) and name not in key_columns + [index_column, row_number_column]]
+    if not mean_columns:
+        return f'SELECT * FROM ({query}) {keep_one_row}'
+    means = ', '.join(f'avg({quote_name(name)}) OVER (PARTITION BY {key}) AS {quote_name(name)}' for name in mean_columns)
+    return f'SELECT * REPLACE ({means}) FROM ({query}) {keep_one_row}'
+
+def missing_sql(connection, query, columns, step, index_column):
+    data_columns = {name: column_type for name, column_type in columns.items() if name not in (index_column, row_number_column)}
+    if step['action'] == 'delete':
+        conditions = [f'{quote_name(name)} IS NOT NULL' for name in data_columns]
+        conditions += [f'NOT isnan({quote_name(name)})' for name, column_type in data_columns.items() if is_float_type(column_type)]
+        if not conditions:
+            return query
+        return f'SELECT * FROM ({query}) WHERE ' + ' AND '.join(conditions)
+    # Columns keep their type when the fill value fits it, otherwise they become text (like an object column in pandas)
+    fill_value = quote_text(step['value'])
+    replacements = []
+    for name, column_type in data_columns.items():
+        fits = connection.execute(f'SELECT TRY_CAST({fill_value} AS {column_type}) IS NOT NULL').fetchone()[0]
+        if fits:
+            missing = f'{quote_name(name)} IS NULL' + (f' OR isnan({quote_name(name)})' if is_float_type(column_type) else '')
+            replacements.append(f'CASE WHEN {missing} THEN CAST({fill_value} AS {column_type}) ELSE {quote_name(name)} END AS {quote_name(name)}')
+        else:
+            replacements.append(f'coalesce(CAST({quote_name(name)} AS VARCHAR), {fill_value}) AS {quote_name(name)}')
+    if not replacements:
+        return query
+    return f'SELECT * REPLACE ({", ".join(replacements)}) FROM ({query})'
+
+def convert_sql(query, columns, step):
+    names = step['columns']
+    if step['type'] == 'Convert to Floats':
+        conversions = [f'CAST({quote_name(name)} AS DOUBLE) AS {quote_name(name)}' for name in names]
+    elif step['type'] == 'Convert to Strings':
+        conversions = [f'CAST({quote_name(name)} AS VARCHAR) AS {quote_name(name)}' for name in names]
+    else:
+        # Floats are truncated towards zero like in pandas (DuckDB would round them)
+        conversions = []
+        for name in names:
+            value = quote_name(name)
+            if step.get('non_finite') == 'replace':
+                non_finite = f'{value} IS NULL' + (f' OR NOT isfinite({value})' if is_float_type(columns[name]) else '')
+                value = f'CASE WHEN {non_finite} THEN {step["replace_value"]} ELSE {value} END'
+            if is_float_type(columns[name]) or str(columns[name]).startswith('DECIMAL'):
+                value = f'trunc({value})'
+            conversions.append(f'CAST({value} AS BIGINT) AS {quote_name(name)}')
+        if step.get('non_finite') == 'drop':
+            conditions = [f'{quote_name(name)} IS NOT NULL' + (f' AND isfinite({quote_name(name)})' if is_float_type(columns[name]) else '')
+                          for name in names]
+            query = f'SELECT * FROM ({query}) WHERE ' + ' AND '.join(conditions)
+    return f'SELECT * REPLACE ({", ".join(conversions)}) FROM ({query})'
+
+def split_sql(connection, query, step):
+    parts_of = f'string_split(CAST({quote_name(step["column"])} AS VARCHAR), {quote_text(step["separator"])})'
+    parts = step.get('parts')
+    if parts is None:
+        parts = connection.execute(f'SELECT coalesce(max(len({parts_of})), 1) FROM ({query})').fetchone()[0]
+    # Like pandas, the rest of the value stays in the last column
+    new_columns = [f'{parts_of}[{i + 1}]' for i in range(parts - 1)]
+    new_columns.append(f'CASE WHEN len({parts_of}) >= {parts} THEN array_to_string({parts_of}[{parts}:], {quote_text(step["separator"])}) END')
+    names = get_split_column_names(step['column'], parts)
+    return 'SELECT *, ' + ', '.join(f'{value} AS {quote_name(name)}' for value, name in zip(new_columns, names)) + f' FROM ({query})'
+
+def concat_sql(query, step):
+    # Missing values are written as 'nan', as pandas does
+    values = ', '.join(f"coalesce(CAST({quote_name(name)} AS VARCHAR), 'nan')" for name in step['columns'])
+    return f'SELECT *, concat_ws({quote_text(step["separator"])}, {values}) AS {quote_name(step["name"])} FROM ({query})'
+
+def select_columns_sql(query, columns, names, index_column):
+    # The index and the row number are always kept, as in pandas where they are not columns
+    missing_names = [name for name in names if name not in columns]
+    if missing_names:
+        raise KeyError(f'Columns not found: {missing_names}')
+    selected = [index_column] + [name for name in names if name != index_column] + [row_number_column]
+    return f'SELECT {", ".join(quote_name(name) for name in selected)} FROM ({query})'
+
+# Function to get the columns (name: type) of a query without running it
+def get_query_columns(connection, query):
+    relation = connection.sql(query)
+    return dict(zip(relation.columns, relation.types))
+
+# Function to translate all cleaning steps to one SQL query, the columns after each step are asked from DuckDB
+# (without reading the data)
+def build_cleaning_query(connection, table_name, steps):
+    query = f'SELECT *, rowid AS {row_number_column} FROM {quote_name(table_name)}'
+    columns = get_query_columns(connection, query)
+    index_column = next(iter(columns))
+    for step in steps:
+        if step['step'] == 'duplicates':
+            query = duplicates_sql(query, columns, step, index_column)
+        elif step['step'] == 'missing':
+            query = missing_sql(connection, query, columns, step, index_column)
+        elif step['step'] == 'convert':
+            query = convert_sql(query, columns, step)
+        elif step['step'] == 'split':
+            query = split_sql(connection, query, step)
+        elif step['step'] == 'concat':
+            query = concat_sql(query, step)
+        elif step['step'] == 'keep_columns':
+            query = select_columns_sql(query, columns, step['columns'], index_column)
+        elif step['step'] == 'delete_columns':
+            kept = [name for name in columns if name not in step['columns'] and name != row_number_column]
+            query = select_columns_sql(query, columns, kept, index_column)
+        elif step['step'] == 'drop_duplicate_columns':
+            raise ValueError('The duckdb backend cannot compare whole columns, use the pandas backend')
+        columns = get_query_columns(connection, query)
+    return f'SELECT * EXCLUDE ({row_number_column}) FROM ({query}) ORDER BY {row_number_column}'
+
+# Function to clean a file with DuckDB and write the result to output_path
+# memory_limit (for example '4GB') is the memory DuckDB may use before it spills to a temporary folder next to the output
+def clean_file_with_duckdb(path, file_format, steps, output_path, output_format, memory_limit=None):
+    if duckdb is None:
+        raise ImportError('The duckdb backend needs the duckdb package (pip install duckdb)')
+    if file_format not in duckdb_input_formats or output_format not in duckdb_output_formats:
+        raise ValueError(f'The duckdb backend reads {", ".join(duckdb_input_formats)} files and writes {", ".join(duckdb_output_formats)} files')
+    output_folder = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=output_folder) as work_folder:
+        # The file is loaded into a database on disk once, so its rows keep their order (rowid) and every pass over
+        # the data reads the compact database instead of parsing the file again
+        connection = duckdb.connect(os.path.join(work_folder, 'cleaning.duckdb'))
+        try:
+            connection.execute(f'SET temp_directory = {quote_text(work_folder)}')
+            if memory_limit:
+                connection.execute(f'SET memory_limit = {quote_text(memory_limit)}')
+            connection.execute('SET preserve_insertion_order = true')
+            connection.execute(f'CREATE TABLE data AS {get_read_sql(path, file_format)}')
+            query = build_cleaning_query(connection, 'data', steps)
+            copy_format = 'PARQUET, COMPRESSION ZSTD' if output_format == 'Parquet' else 'CSV, HEADER'
+            connection.execute(f'COPY ({query}) TO {quote_text(output_path)} (FORMAT {copy_format})')
+        finally:
+            connection.close()
+    return output_path
@@ -0,0 +1,1256 @@
+# Cleaning engine of the data cleaning webtool
+# These functions read the uploaded files and replay the recorded cleaning steps without any Streamlit code,
+# so they can also run in the worker processes of the batch mode
+import numpy as np
+import pandas as pd
+import io
+import os
+import csv
+import gzip
+import bz2
+import zipfile
+import tempfile
+import json
+import datetime
+import itertools
+import difflib
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# Version of pandas as (major, minor), some features depend on it
+pandas_version = tuple(int(part) for part in pd.__version__.split('.')[:2])
+
+# Parquet and Feather (Arrow IPC) files need pyarrow, the webtool still works with Excel/CSV/TSV without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+# zstd compressed uploads need the zstandard package
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Recipes can also be saved as YAML when PyYAML is installed, JSON always works
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Fast string similarity for near-duplicate keys (written in C++), difflib is used when it is not installed
+try:
+    from rapidfuzz import fuzz
+except ImportError:
+    fuzz = None
+
+# Fast Excel reader (calamine, written in Rust), pandas uses openpyxl/xlrd when it is not installed
+# pandas supports the calamine engine from version 2.2
+try:
+    import python_calamine
+    excel_engine = 'calamine' if pandas_version >= (2, 2) else None
+except ImportError:
+    excel_engine = None
+
+# Functions to read compressed uploads (.gz, .bz2, .zst and .zip) without decompressing them first
+# Function to find the compression of an upload from the first bytes of the file
+# Excel files are zip archives themselves, so zip is only checked for the other formats
+def detect_compression(upload, file_format):
+    upload.seek(0)
+    magic = upload.read(4)
+    upload.seek(0)
+    if magic[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if magic[:3] == b'BZh':
+        return 'bz2'
+    if magic == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    if magic == b'PK\x03\x04' and file_format != 'Excel':
+        return 'zip'
+    return None
+
+# Function to list the files in a zip archive
+def get_zip_members(upload):
+    upload.seek(0)
+    with zipfile.ZipFile(upload) as archive:
+        return [info.filename for info in archive.infolist() if not info.is_dir()]
+
+# Function to open a stream that decompresses the upload while it is read
+def open_decompressed_stream(upload, compression, member=None):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=upload, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(upload, 'rb')
+    if compression == 'zstd':
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(upload, closefd=False))
+    return zipfile.ZipFile(upload).open(member)
+
+# File-like object that decompresses an upload while it is read, so a compressed CSV/TSV file goes straight
+# into the (chunked) CSV reader. Only the compressed file is kept in memory.
+# It can only be rewound to the start, which opens a new decompression stream
+class DecompressedUpload(io.RawIOBase):
+    def __init__(self, upload, compression, member=None):
+        self.upload = upload
+        self.compression = compression
+        self.member = member
+        self.stream = None
+        self.seek(0)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('A compressed upload can only be read again from the start')
+        if self.stream is not None:
+            self.stream.close()
+        self.upload.seek(0)
+        self.stream = open_decompressed_stream(self.upload, self.compression, self.member)
+        return 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    # The size of the compressed content decides if the upload is staged on disk
+    def getbuffer(self):
+        return self.upload.getbuffer()
+
+# Function to open a compressed upload: CSV/TSV files are decompressed while they are read,
+# the other formats need random access to the file and are decompressed in memory
+def open_compressed_upload(upload, file_format, compression, member=None):
+    decompressed = DecompressedUpload(upload, compression, member)
+    if file_format in ('CSV', 'TSV'):
+        return decompressed
+    with decompressed:
+        return io.BytesIO(decompressed.read())
+
+# Functions to find the layout of a CSV/TSV file from a sample of its first rows, before reading the whole file
+# Size of the sample read from the start of the file
+sniff_sample_bytes = 1024 * 1024
+
+# Function to find the encoding of the sample (Excel often saves CSV files with a byte order mark or in latin-1)
+def sniff_encoding(sample):
+    if sample.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    try:
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+# Function to choose data types that use less memory than the pandas defaults for every column of the sample
+# Only text columns with many repeated values are read as category, which keeps every value as it is. Numbers are
+# not given a type here: pandas wraps values that do not fit a narrower integer type without an error, and float32
+# rounds decimals (see narrow_integer_columns)
+def choose_compact_dtypes(sample_df):
+    dtypes = {}
+    for column in sample_df.columns:
+        values = sample_df[column]
+        if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            if len(values) >= 20 and values.nunique() <= len(values) * 0.5:
+                dtypes[column] = 'category'
+    return dtypes
+
+# Function to store integer columns as int32 when all their values fit, checked over the whole DataFrame after it
+# was read, so no value changes. Decimals stay float64
+def narrow_integer_columns(df):
+    int32_range = np.iinfo(np.int32)
+    narrow_columns = {}
+    for column in df.columns[(df.dtypes == 'int64').values]:
+        values = df[column]
+        if values.empty or (values.min() >= int32_range.min and values.max() <= int32_range.max):
+            narrow_columns[column] = 'int32'
+    if not narrow_columns or not df.columns.is_unique:
+        return df
+    return astype_columns(df, narrow_columns)
+
+# Function to find the delimiter, the encoding and compact data types of a CSV/TSV file
+# Compact data types are only chosen when asked for (the webtool), the cleaned files of the batch mode, the command
+# line and the service are read with the pandas defaults
+def sniff_csv_schema(upload, default_sep, compact_dtypes=False):
+    upload.seek(0)
+    sample = upload.read(sniff_sample_bytes)
+    upload.seek(0)
+    # Only keep complete lines of the sample
+    if len(sample) == sniff_sample_bytes and b'\n' in sample:
+        sample = sample[:sample.rindex(b'\n') + 1]
+    encoding = sniff_encoding(sample)
+    text = sample.decode(encoding)
+    try:
+        sep = csv.Sniffer().sniff(text[:64 * 1024], delimiters=',\t;|').delimiter
+    except csv.Error:
+        sep = default_sep
+    dtype = None
+    if compact_dtypes:
+        sample_df = pd.read_csv(io.StringIO(text), sep=sep, index_col = 0)
+        dtype = choose_compact_dtypes(sample_df)
+    return {'sep': sep, 'encoding': encoding, 'dtype': dtype}
+
+# Function to read a CSV/TSV file in chunks of a fixed number of rows
+# The file is rewound every time so the chunks can be read again for every pass over the file
+def read_in_chunks(upload, sep, chunk_size, encoding='utf-8', dtype=None):
+    upload.seek(0)
+    with pd.read_csv(upload, sep=sep, index_col = 0, chunksize=chunk_size, encoding=encoding, dtype=dtype) as reader:
+        for chunk in reader:
+            yield chunk
+
+# Functions to read Parquet and Feather files with pyarrow
+# Function to get the columns stored in a Parquet or Feather file without reading the data
+def get_arrow_schema(upload, file_format):
+    upload.seek(0)
+    if file_format == 'Parquet':
+        schema = pq.read_schema(upload)
+    else:
+        schema = pa.ipc.open_file(upload).schema
+    upload.seek(0)
+    return schema
+
+# Function to find the index column of a Parquet or Feather file
+# Files written by pandas store their index, for other files the first column is used as the index
+def get_arrow_index_columns(schema):
+    pandas_metadata = schema.pandas_metadata or {}
+    index_columns = [column for column in pandas_metadata.get('index_columns', []) if isinstance(column, str)]
+    if not index_columns and not pandas_metadata:
+        index_columns = [schema.names[0]]
+    return index_columns
+
+# Function to read only the selected columns of a Parquet or Feather file
+# The columns are converted to pandas without copying them where pyarrow allows it (numeric columns without missing values)
+def read_arrow_file(upload, file_format, columns=None):
+    schema = get_arrow_schema(upload, file_format)
+    index_columns = get_arrow_index_columns(schema)
+    # No selected columns (None or an empty list) means all columns
+    columns = index_columns + [column for column in columns if column not in index_columns] if columns else None
+    if file_format == 'Parquet':
+        table = pq.read_table(upload, columns=columns, use_pandas_metadata=True)
+    else:
+        table = feather.read_table(upload, columns=columns, memory_map=True)
+    df = arrow_table_to_dataframe(table, split_blocks=True, self_destruct=True)
+    del table
+    if index_columns and index_columns[0] in df.columns:
+        df = df.set_index(index_columns[0])
+    return df
+
+# Columns with mixed values (for example gene names that Excel turned into dates) cannot be stored in Arrow as they are.
+# They are stored as text, and the values that were not text are kept in the metadata of the table under this key,
+# so arrow_table_to_dataframe gives back the same values and the same (object) data type
+mixed_columns_metadata_key = b'data_cleaning_webtool.mixed_columns'
+
+# Function to describe the values of a mixed column that are not text: their row numbers, kinds and values
+# Dates, numbers, booleans and missing values are kept, any other value stays text
+def get_mixed_values(values):
+    mixed_values = {'positions': [], 'kinds': [], 'values': []}
+    for position, value in enumerate(values):
+        if isinstance(value, str):
+            continue
+        if value is None:
+            kind, value = 'None', None
+        elif isinstance(value, (bool, np.bool_)):
+            kind, value = 'bool', bool(value)
+        elif isinstance(value, (int, np.integer)):
+            kind, value = 'int', int(value)
+        elif isinstance(value, (float, np.floating)):
+            kind, value = 'float', None if np.isnan(value) else float(value)
+        elif isinstance(value, pd.Timestamp):
+            kind, value = 'Timestamp', value.isoformat()
+        elif isinstance(value, datetime.datetime):
+            kind, value = 'datetime', value.isoformat()
+        else:
+            continue
+        mixed_values['positions'].append(position)
+        mixed_values['kinds'].append(kind)
+        mixed_values['values'].append(value)
+    return mixed_values
+
+# Function to turn a value described by get_mixed_values back into the original value
+def restore_mixed_value(kind, value):
+    if kind == 'float':
+        return np.nan if value is None else value
+    if kind == 'Timestamp':
+        return pd.Timestamp(value)
+    if kind == 'datetime':
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+# Function to convert a DataFrame (with its index) to a pyarrow table
+def dataframe_to_arrow_table(df):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        mixed_columns = [column for column, dtype in df.dtypes.items() if pd.api.types.is_object_dtype(dtype)]
+        table = pa.Table.from_pandas(df.astype({column: 'string' for column in mixed_columns}), preserve_index=True)
+        mixed_values = {str(column): get_mixed_values(df[column]) for column in mixed_columns}
+        metadata = dict(table.schema.metadata or {})
+        metadata[mixed_columns_metadata_key] = json.dumps(mixed_values).encode()
+        return table.replace_schema_metadata(metadata)
+
+# Function to convert a pyarrow table to a DataFrame, the mixed columns stored by dataframe_to_arrow_table are restored
+# options are passed to Table.to_pandas
+def arrow_table_to_dataframe(table, **options):
+    metadata = table.schema.metadata or {}
+    mixed_values = json.loads(metadata[mixed_columns_metadata_key]) if mixed_columns_metadata_key in metadata else {}
+    df = table.to_pandas(**options)
+    restored = {}
+    for column in df.columns:
+        if str(column) not in mixed_values:
+            continue
+        values = df[column].to_numpy(dtype=object, copy=True)
+        column_values = mixed_values[str(column)]
+        for position, kind, value in zip(column_values['positions'], column_values['kinds'], column_values['values']):
+            values[position] = restore_mixed_value(kind, value)
+        restored[column] = pd.Series(values, index=df.index, dtype=object)
+    if not restored:
+        return df
+    return replace_columns(df, [pd.DataFrame(restored, index=df.index)])
+
+# Functions to read Excel files with the fastest installed engine
+# Function to get the names of the sheets in an Excel file
+def get_excel_sheet_names(upload):
+    upload.seek(0)
+    with pd.ExcelFile(upload, engine=excel_engine) as excel_file:
+        return excel_file.sheet_names
+
+# Function to read one sheet of an Excel file, or only its first rows (nrows) for a quick preview
+def read_excel_sheet(upload, sheet_name=0, nrows=None):
+    upload.seek(0)
+    return pd.read_excel(upload, sheet_name=sheet_name, index_col = 0, nrows=nrows, engine=excel_engine)
+
+# Function to read a CSV/TSV file with the layout found by sniff_csv_schema
+# With compact data types (dtype is not None) the integer columns whose values all fit are stored as int32
+def read_csv_file(upload, sep, encoding='utf-8', dtype=None):
+    upload.seek(0)
+    df = pd.read_csv(upload, sep=sep, index_col = 0, encoding=encoding, dtype=dtype)
+    return df if dtype is None else narrow_integer_columns(df)
+
+# Function to convert an uploaded file to a DataFrame
+def read_uploaded_file(upload, file_format, columns=None, sheet_name=0, sep=None, encoding='utf-8', dtype=None):
+    upload.seek(0)
+    if file_format == 'Excel':
+        return read_excel_sheet(upload, sheet_name)
+    elif file_format in ('CSV', 'TSV'):
+        default_sep = ',' if file_format == 'CSV' else '\t'
+        return read_csv_file(upload, sep or default_sep, encoding, dtype)
+    elif file_format in ('Parquet', 'Feather'):
+        return read_arrow_file(upload, file_format, columns)
+
+# Functions to write the cleaned data to a file
+# File name extension and MIME type of every download format
+download_formats = {
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'Feather': ('feather', 'application/vnd.apache.arrow.file'),
+}
+
+# Number of rows written to the download file at a time
+download_block_rows = 100000
+
+# Function to write a DataFrame to a file in the chosen format
+# Excel and CSV files are written a block of rows at a time. progress (optional) is called after every block with
+# the fraction of rows written, it can stop the writing by raising an exception.
+def write_download_file(df, path, file_format, progress=None):
+    blocks = range(0, max(len(df), 1), download_block_rows)
+    if file_format == 'Excel':
+        with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+            for start in blocks:
+                # The header is only written with the first block, the next blocks start below the rows before them
+                df.iloc[start:start + download_block_rows].to_excel(writer, index=True, header=start == 0,
+                                                                     startrow=start + 1 if start else 0)
+                if progress is not None:
+                    progress(min(start + download_block_rows, len(df)) / max(len(df), 1))
+    elif file_format == 'CSV':
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            for start in blocks:
+                df.iloc[start:start + download_block_rows].to_csv(file, index=True, header=start == 0)
+                if progress is not None:
+                    progress(min(start + download_block_rows, len(df)) / max(len(df), 1))
+    else:
+        table = dataframe_to_arrow_table(df)
+        if file_format == 'Parquet':
+            pq.write_table(table, path, row_group_size=download_block_rows)
+        else:
+            feather.write_feather(table, path, chunksize=download_block_rows)
+        if progress is not None:
+            progress(1.0)
+
+# Copy-on-write: a DataFrame made from another one shares the columns it did not change with it, a column is only
+# copied when one of the two DataFrames is changed. The cleaning operations never change their input, so with
+# copy-on-write they only allocate memory for the columns and rows they really change instead of a full copy.
+# It is always on from pandas 3.0 and is turned on here for pandas 2.x.
+def enable_copy_on_write():
+    if (2, 0) <= pandas_version < (3, 0):
+        pd.set_option('mode.copy_on_write', True)
+
+def is_copy_on_write_enabled():
+    if pandas_version >= (3, 0):
+        return True
+    return pandas_version >= (2, 0) and pd.get_option('mode.copy_on_write') is True
+
+enable_copy_on_write()
+
+# Function to copy a DataFrame, with copy-on-write the copy is lazy and shares the data until one of them is changed
+def copy_dataframe(df):
+    return df.copy(deep=not is_copy_on_write_enabled())
+
+# Function to run a cleaning operation and measure the memory it allocates, with tracemalloc (which also counts the
+# arrays of numpy and so of pandas, but not text columns stored by pyarrow)
+# Returns the result and the bytes allocated: 'kept' by the result and at most at once ('peak') during the operation.
+# tracemalloc counts the allocations of all threads, so measured operations run one at a time
+allocation_lock = threading.Lock()
+
+def measure_allocations(function, *args):
+    with allocation_lock:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        try:
+            result = function(*args)
+            kept, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+    return result, {'kept': max(kept - start, 0), 'peak': max(peak - start, 0)}
+
+# Cleaning operations, used by the webtool, the command line and the replay of the recorded steps
+# Every operation returns a new DataFrame (or Series) and never changes its input
+# The actions and conversion types have the same names as the options in the webtool
+
+duplicate_actions = ('Take mean of duplicates', 'Choose only the first value', 'Choose only the last value', 'Ignore')
+conversion_types = ('Convert to Integers', 'Convert to Floats', 'Convert to Strings')
+conversion_dtypes = dict(zip(conversion_types, (int, float, str)))
+
+# Short names of the options, used on the command line and by the HTTP service
+duplicate_action_names = dict(zip(('mean', 'first', 'last', 'ignore'), duplicate_actions))
+conversion_type_names = dict(zip(('int', 'float', 'str'), conversion_types))
+
+# Function to get the key columns of a duplicates step: one column name, or a list of names for a composite key
+def get_key_columns(column_name):
+    return list(column_name) if isinstance(column_name, (list, tuple)) else [column_name]
+
+# Function to get one 64-bit hash per row of the key columns, so a composite key is found with the same O(n)
+# duplicated and groupby as a single column, without building a tuple per row
+# Rows with the same hash are checked to have the same key values. In the very unlikely case of a collision the
+# rows are numbered by their exact key values instead (ngroup, also without tuples)
+def hash_composite_keys(df, columns):
+    key_columns = df[columns]
+    hashes = pd.util.hash_pandas_object(key_columns, index=False)
+    codes, _ = pd.factorize(hashes.values)
+    # codes are numbered in the order they first occur, so the first row of every hash is found with duplicated
+    first_positions = np.flatnonzero(~pd.Series(codes).duplicated().values)[codes]
+    for column in columns:
+        values = key_columns[column].reset_index(drop=True)
+        first_values = values.take(first_positions).reset_index(drop=True)
+        same = values.eq(first_values).to_numpy(dtype=bool, na_value=False) | (values.isna() & first_values.isna()).values
+        if not same.all():
+            return key_columns.groupby(columns, dropna=False, sort=False).ngroup()
+    return hashes
+
+# Ways to match the keys of duplicates:
+# exact: the values must be the same
+# normalized: the values are the same without case, spaces and a version suffix (TP53 = "tp53 " = TP53.1)
+# similar: normalized values that differ by a small typo in their letters are also the same (see find_similar_keys)
+duplicate_matches = ('exact', 'normalized', 'similar')
+# Version suffix of identifiers (TP53.1, ENST00000269305.9) and the spaces that are removed from normalized keys
+version_suffix_pattern = r'\.\d+$'
+# Similar keys: the smallest similarity (0 to 1) of two normalized keys, and the number of following keys in sorted
+# order every key is compared with. 0.9 keeps apart gene names that differ in one digit (BRCA1, BRCA2)
+similar_key_ratio = 0.9
+similar_key_window = 3
+
+# Function to normalize string keys: no case, no spaces and no version suffix, missing values stay missing
+# Only the distinct values are normalized, other keys (numbers, dates) are returned as they are
+def normalize_keys(keys):
+    is_categorical = isinstance(keys.dtype, pd.CategoricalDtype)
+    if not pd.api.types.is_string_dtype(keys.cat.categories.dtype if is_categorical else keys.dtype):
+        return keys
+    codes, uniques = pd.factorize(keys)
+    normalized = pd.Series(uniques, dtype='str').str.lower().str.replace(r'\s+', '', regex=True)
+    normalized = normalized.str.replace(version_suffix_pattern, '', regex=True).to_numpy(dtype=object)
+    values = normalized[codes]
+    values[codes < 0] = np.nan
+    return pd.Series(values, index=keys.index, dtype='str')
+
+# Function to get the similarity of two keys between 0 and 1
+def get_key_similarity(first, second):
+    if fuzz is not None:
+        return fuzz.ratio(first, second) / 100
+    return difflib.SequenceMatcher(None, first, second).ratio()
+
+# Function to find groups of similar keys with a sorted neighbourhood: the distinct keys are sorted and every key is
+# only compared with the next similar_key_window keys, so the time grows with the number of keys, not its square
+# A key only joins a group when it is also similar to the first key of the group, so chains of small differences
+# (GENE1, GENE10, GENE100) do not end up in one group. Keys with different numbers are never similar, the numbers
+# tell identifiers apart (BRCA1 and BRCA2, ENSG00000141510 and ENSG00000141511)
+# Returns the keys that belong to a group with the first key of their group (a Series key: first key)
+def find_similar_keys(keys):
+    sorted_keys = sorted(set(keys.dropna()))
+    key_numbers = dict(zip(sorted_keys, pd.Series(sorted_keys, dtype='str').str.replace(r'\D', '', regex=True)))
+    first_keys = {}
+    for position, key in enumerate(sorted_keys):
+        first_key = first_keys.get(key, key)
+        for other_key in sorted_keys[position + 1:position + 1 + similar_key_window]:
+            if other_key in first_keys or key_numbers[other_key] != key_numbers[first_key]:
+                continue
+            # Keys whose lengths differ too much cannot be similar enough
+            if 2 * min(len(first_key), len(other_key)) < similar_key_ratio * (len(first_key) + len(other_key)):
+                continue
+            if get_key_similarity(first_key, other_key) >= similar_key_ratio:
+                first_keys[other_key] = first_key
+    return pd.Series(first_keys, dtype='str')
+
+# Function to match the keys of one column (or the index) as exact, normalized or similar keys
+# similar_keys are the groups of find_similar_keys when they were found before (over all chunks of a file)
+def match_keys(keys, match='exact', similar_keys=None):
+    if match == 'exact':
+        return keys
+    keys = normalize_keys(keys)
+    if match == 'similar' and pd.api.types.is_string_dtype(keys.dtype):
+        if similar_keys is None:
+            similar_keys = find_similar_keys(keys)
+        first_keys = keys.map(similar_keys)
+        keys = first_keys.where(first_keys.notna(), keys)
+    return keys
+
+# Function to get the values used to find duplicates: a column, several columns (a composite key) or the index
+# similar_keys is a dict key column: groups of similar keys, the index has the key column None
+def get_duplicate_keys(df, column_name=None, use_index=False, match='exact', similar_keys=None):
+    similar_keys = similar_keys or {}
+    if use_index:
+        return match_keys(df.index.to_series(index=df.index), match, similar_keys.get(None))
+    columns = get_key_columns(column_name)
+    if len(columns) == 1:
+        return match_keys(df[columns[0]], match, similar_keys.get(columns[0]))
+    if match != 'exact':
+        df = pd.DataFrame({column: match_keys(df[column], match, similar_keys.get(column)) for column in columns})
+    return hash_composite_keys(df, columns)
+
+# Function to find all rows whose value in the column(s) (or index) occurs more than once
+# Rows with near-duplicate keys are sorted by their matched key, so every group of candidates is shown together
+def find_duplicated_rows(df, column_name=None, use_index=False, match='exact'):
+    keys = get_duplicate_keys(df, column_name, use_index, match)
+    is_duplicated = keys.duplicated(keep=False).values
+    if match == 'exact':
+        return df[is_duplicated]
+    codes, _ = pd.factorize(keys[is_duplicated], use_na_sentinel=False)
+    return df[is_duplicated].iloc[np.argsort(codes, kind='stable')]
+
+# Number of the largest duplicate groups listed in the summary of the duplicates
+duplicate_summary_top_keys = 10
+
+# Function to number the groups of duplicates by size, the largest group first (groups of the same size in the order
+# of their first row). Returns the group number of every row (-1 for rows whose key occurs once) and the group sizes
+def rank_duplicate_groups(df, column_name=None, use_index=False, match='exact'):
+    codes, _ = pd.factorize(get_duplicate_keys(df, column_name, use_index, match), use_na_sentinel=False)
+    sizes = np.bincount(codes, minlength=1)
+    order = np.argsort(-sizes, kind='stable')
+    order = order[sizes[order] > 1]
+    ranks = np.full(len(sizes), -1)
+    ranks[order] = np.arange(len(order))
+    return ranks[codes], sizes[order]
+
+# Function to summarize the duplicates in one pass over the keys, instead of showing every duplicated row:
+# the number of groups, the number of rows in them, the number of groups of every size and the largest groups
+def summarize_duplicates(df, column_name=None, use_index=False, match='exact', top_keys=duplicate_summary_top_keys):
+    groups, sizes = rank_duplicate_groups(df, column_name, use_index, match)
+    # First row of every listed group, in the order of the groups
+    top_positions = np.flatnonzero((groups >= 0) & (groups < top_keys))
+    first_positions = top_positions[~pd.Series(groups[top_positions]).duplicated().values]
+    first_positions = first_positions[np.argsort(groups[first_positions])]
+    if use_index:
+        largest_groups = df.index[first_positions].to_frame(index=False, name=df.index.name or 'Index')
+    else:
+        largest_groups = df[get_key_columns(column_name)].iloc[first_positions].reset_index(drop=True)
+    largest_groups['Rows'] = sizes[:len(first_positions)]
+    group_sizes = pd.Series(sizes).value_counts().sort_index()
+    group_sizes.index.name = 'Group size'
+    return {'groups': len(sizes), 'rows': int(sizes.sum()), 'group_sizes': group_sizes.rename('Groups'),
+            'largest_groups': largest_groups}
+
+# Function to get the rows of the duplicate groups first_group up to (not including) last_group, numbered as in
+# rank_duplicate_groups, so the groups can be shown one page at a time
+def find_duplicate_groups(df, column_name=None, use_index=False, match='exact', first_group=0, last_group=None):
+    groups, sizes = rank_duplicate_groups(df, column_name, use_index, match)
+    last_group = len(sizes) if last_group is None else last_group
+    in_page = (groups >= first_group) & (groups < last_group)
+    return df[in_page].iloc[np.argsort(groups[in_page], kind='stable')]
+
+# Function to get the numeric columns that get the mean of the duplicates (all but the key columns themselves)
+def get_mean_columns(df, column_name=None, use_index=False):
+    key_columns = [] if use_index else get_key_columns(column_name)
+    return [column for column in df.select_dtypes(include='number').columns if column not in key_columns]
+
+# Function to take the mean of the numeric columns of duplicates, the other columns keep the value of the first row
+# All numeric columns are averaged in one groupby over the keys, numbered in the order they first occur so the groups
+# line up with the first rows. Missing keys form one group, as they do for duplicated.
+def take_mean_of_duplicates(df, column_name=None, use_index=False, match='exact'):
+    keys = get_duplicate_keys(df, column_name, use_index, match)
+    first_rows = df[~keys.duplicated(keep='first').values]
+    mean_columns = get_mean_columns(df, column_name, use_index)
+    if not mean_columns or len(first_rows) == len(df):
+        # Nothing to average, the columns keep their data types
+        return first_rows
+    codes, _ = pd.factorize(keys, use_na_sentinel=False)
+    means = df[mean_columns].groupby(codes, sort=True).mean().astype('float64')
+    means.index = first_rows.index
+    return replace_columns(first_rows, [means])
+
+# Function to handle duplicates in a column, a composite key or the index with one of the duplicate_actions
+def remove_duplicates(df, column_name=None, action='Ignore', use_index=False, match='exact'):
+    keys = get_duplicate_keys(df, column_name, use_index, match)
+    if action == 'Choose only the first value':
+        return df[~keys.duplicated(keep='first').values]
+    if action == 'Choose only the last value':
+        return df[~keys.duplicated(keep='last').values]
+    if action == 'Take mean of duplicates':
+        return take_mean_of_duplicates(df, column_name, use_index, match)
+    return df
+
+# Function to find all rows with at least one missing value
+def find_rows_with_missing_values(df):
+    return df[df.isnull().any(axis=1)]
+
+# Function to delete all rows with at least one missing value
+def remove_rows_with_missing_values(df):
+    return df.dropna(axis=0, how='any')
+
+# Function to fill missing values, the fill value is first added to the categories of category columns
+# Only the columns with missing values are filled, the other columns are shared with df (with copy-on-write)
+def fill_missing_values(df, fill_value):
+    if not df.columns.is_unique:
+        missing_columns = list(df.columns)
+    else:
+        missing_columns = [column for column, has_missing in df.isnull().any().items() if has_missing]
+    if not missing_columns:
+        return copy_dataframe(df)
+    category_columns = [column for column in df[missing_columns].select_dtypes(include='category').columns
+                        if fill_value not in df[column].cat.categories]
+    if category_columns:
+        df = df.astype({column: pd.CategoricalDtype(list(df[column].cat.categories) + [fill_value]) for column in category_columns})
+    if not df.columns.is_unique:
+        return df.fillna(fill_value)
+    return df.fillna({column: fill_value for column in missing_columns})
+
+# Function to check if the columns contain NaN or infinite values, these cannot be converted to integers
+def has_non_finite_values(df, columns):
+    values = df[columns]
+    numeric_values = values.select_dtypes(include='number')
+    return bool(values.isnull().any().any() or np.isinf(numeric_values).any().any())
+
+# Columns are converted and split by several threads at once. numpy converts numbers (and pyarrow splits text)
+# without holding the GIL, so the threads really run in parallel on wide or long data
+parallel_workers = os.cpu_count() or 1
+# Smallest number of values in one part of the work, smaller parts cost more in threads than they gain
+parallel_min_values = 1000000
+
+# Function to divide a number of columns (or rows) into parts for the worker threads, as slices
+# There are a few parts per worker, so the threads stay busy when some parts take longer than others
+def get_parallel_slices(count, values_per_item):
+    parts = min(parallel_workers * 4, count * max(values_per_item, 1) // parallel_min_values)
+    if parallel_workers == 1 or parts <= 1:
+        return [slice(0, count)]
+    size = -(-count // parts)
+    return [slice(start, start + size) for start in range(0, count, size)]
+
+# Function to run a function on every part in the worker threads, the results are in the order of the parts
+def map_in_parallel(function, parts):
+    if len(parts) == 1:
+        return [function(parts[0])]
+    with ThreadPoolExecutor(max_workers=parallel_workers) as executor:
+        return list(executor.map(function, parts))
+
+# Largest number of columns that are set one by one in a lazy copy (see replace_columns)
+replace_columns_set_max = 100
+
+# Function to replace columns of df by the columns of blocks (DataFrames with the same rows as df)
+def replace_columns(df, blocks):
+    replaced_columns = [column for block in blocks for column in block.columns]
+    if len(replaced_columns) <= replace_columns_set_max and is_copy_on_write_enabled():
+        # A few columns are set in a lazy copy of df, the other columns are not copied
+        result = copy_dataframe(df)
+        for block in blocks:
+            for column in block.columns:
+                result[column] = block[column]
+        return result
+    # Many columns are put together in one go, the blocks replace the old columns in the original order
+    return pd.concat([df.drop(columns=replaced_columns)] + blocks, axis=1)[list(df.columns)]
+
+# Function to convert columns to new data types (a dict column: dtype)
+# The columns with the same new type are converted a block of columns at a time, which is much faster than one
+# column at a time for wide data (thousands of sample columns), and the blocks are converted in parallel
+def astype_columns(df, dtypes):
+    if not df.columns.is_unique:
+        return df.astype(dtypes)
+    blocks = []
+    for dtype in set(dtypes.values()):
+        columns = [column for column, column_dtype in dtypes.items() if column_dtype == dtype]
+        convert_block = lambda columns_slice: df[columns[columns_slice]].astype(dtype)
+        blocks += map_in_parallel(convert_block, get_parallel_slices(len(columns), len(df)))
+    return replace_columns(df, blocks)
+
+# Actions for NaN and infinite values when columns are converted to integers
+non_finite_actions = ('replace', 'drop')
+
+# Function to convert columns with one of the conversion_types
+# non_finite decides what happens to NaN and infinite values before converting to integers:
+# 'replace' replaces them by replace_value, 'drop' deletes their rows and None leaves them (and fails on them)
+def convert_columns(df, columns, conversion_type, non_finite=None, replace_value=0):
+    if conversion_type not in conversion_dtypes:
+        raise ValueError(f'Unknown conversion type: {conversion_type}')
+    if conversion_type == 'Convert to Integers':
+        if non_finite == 'replace':
+            df = df.fillna({column: replace_value for column in columns})
+            df = df.replace({column: {np.inf: replace_value, -np.inf: replace_value} for column in columns})
+        elif non_finite == 'drop':
+            # The rows are dropped with one mask, so the kept rows are copied only once
+            values = df[columns]
+            non_finite_rows = values.isnull().any(axis=1).values | np.isinf(values.select_dtypes(include='number')).any(axis=1).values
+            if non_finite_rows.any():
+                df = df[~non_finite_rows]
+    return astype_columns(df, {column: conversion_dtypes[conversion_type] for column in columns})
+
+# Function to get the names of the columns made by splitting a column
+def get_split_column_names(column, parts):
+    return [f'{column}_{i + 1}' for i in range(parts)]
+
+# Function to count into how many columns a column is split, without making the new columns
+def count_split_parts(df, column, separator):
+    if df.empty:
+        return 1
+    return int(df[column].astype(str).str.split(separator).str.len().max())
+
+# Function to split a column (a Series) into new columns named <column>_1, <column>_2, ...
+# With parts the result always has that many columns and the rest stays in the last column
+# Long columns are split a block of rows at a time in parallel
+def split_values(values, column, separator, parts=None):
+    text = values.astype(str)
+    split_rows = lambda rows: text.iloc[rows].str.split(separator, n=-1 if parts is None else parts - 1, expand=True)
+    blocks = map_in_parallel(split_rows, get_parallel_slices(len(text), 1))
+    new_columns = pd.concat(blocks) if len(blocks) > 1 else blocks[0]
+    if parts is None:
+        parts = len(new_columns.columns)
+    new_columns = new_columns.reindex(columns=range(parts))
+    new_columns.columns = get_split_column_names(column, parts)
+    return new_columns
+
+# Function to split a column of a DataFrame into new columns
+def split_column(df, column, separator, parts=None):
+    return split_values(df[column], column, separator, parts)
+
+# Function to concatenate columns into one new column
+# Missing values are written as 'nan' (astype(str) keeps them missing, and join cannot join them)
+def concatenate_columns(df, columns, separator, name='Concatenated_Column'):
+    if df.empty:
+        # Frames (or chunks) without rows still get the new column, so the columns stay the same
+        return pd.Series(index=df.index, dtype=object, name=name)
+    return df[columns].astype(object).fillna('nan').astype(str).agg(separator.join, axis=1).rename(name)
+
+# Function to keep only the selected columns
+def keep_columns(df, columns):
+    return df[columns]
+
+# Function to delete the selected columns
+def delete_columns(df, columns):
+    return df.drop(columns=columns)
+
+# Function to get a fingerprint of the contents of a column: its data type and one 64-bit hash of its row hashes,
+# weighted by the row number (row_weights) so the same values in another order give another fingerprint
+def get_column_fingerprint(column, row_weights):
+    row_hashes = pd.util.hash_pandas_object(column, index=False).to_numpy()
+    return str(column.dtype), int((row_hashes * row_weights).sum())
+
+# Function to find columns with the same contents under different names (for example a sample exported twice)
+# Every column is hashed once (in parallel blocks of columns) and only columns with the same fingerprint are compared.
+# Returns the groups of identical columns as lists of names, the first column of a group is the one to keep
+# Columns whose name occurs more than once are left out, they cannot be deleted by name without the other one
+def find_duplicate_columns(df):
+    if df.empty:
+        return []
+    positions = [position for position, is_duplicated in enumerate(df.columns.duplicated(keep=False)) if not is_duplicated]
+    row_weights = pd.util.hash_array(np.arange(len(df)))
+    get_fingerprints = lambda positions_slice: [get_column_fingerprint(df.iloc[:, position], row_weights)
+                                                for position in positions[positions_slice]]
+    fingerprints = itertools.chain.from_iterable(map_in_parallel(get_fingerprints, get_parallel_slices(len(positions), len(df))))
+    candidates = {}
+    for position, fingerprint in zip(positions, fingerprints):
+        candidates.setdefault(fingerprint, []).append(position)
+    groups = []
+    for same_fingerprint in candidates.values():
+        # Columns with the same fingerprint are compared, so a hash collision never deletes a different column
+        while len(same_fingerprint) > 1:
+            first = df.iloc[:, same_fingerprint[0]]
+            same = [position for position in same_fingerprint[1:] if first.equals(df.iloc[:, position])]
+            if same:
+                groups.append([df.columns[same_fingerprint[0]]] + [df.columns[position] for position in same])
+            same_fingerprint = [position for position in same_fingerprint[1:] if position not in same]
+    return sorted(groups, key=lambda group: df.columns.get_loc(group[0]))
+
+# Function to get the columns to delete from the groups of identical columns, all but the first column of every group
+def get_redundant_columns(groups):
+    return [column for group in groups for column in group[1:]]
+
+# Functions to plan the recorded cleaning steps before they are run
+# Once the columns of the data are known, the steps are turned into a plan that needs about one copy of the data:
+# - columns that are deleted by a later step are dropped before the first step (or not read at all)
+# - split and concatenate steps whose new columns are deleted later are skipped
+# - adjacent split and concatenate steps and the column selection after them add all new columns at once,
+#   instead of making a full copy of the data for every step
+# - adjacent conversions of different columns are done with one astype
+
+# Function to get the columns after a step, None when they are not known before running it
+def get_columns_after_step(columns, step):
+    if columns is None:
+        return None
+    if step['step'] == 'split':
+        if step.get('parts') is None:
+            return None
+        return columns + get_split_column_names(step['column'], step['parts'])
+    if step['step'] == 'concat':
+        return columns + [step['name']]
+    if step['step'] == 'keep_columns':
+        return list(step['columns'])
+    if step['step'] == 'delete_columns':
+        return [column for column in columns if column not in step['columns']]
+    if step['step'] == 'drop_duplicate_columns':
+        return None
+    return columns
+
+# Function to drop the steps whose result is never used and to find the columns every step needs,
+# walking back from the last step. needed is None when all columns are needed.
+def prune_cleaning_steps(steps, columns):
+    step_columns = [list(columns)]
+    for step in steps:
+        step_columns.append(get_columns_after_step(step_columns[-1], step))
+    needed = None
+    pruned = []
+    for step, columns_before in zip(reversed(steps), reversed(step_columns[:-1])):
+        kind = step['step']
+        if kind == 'keep_columns':
+            if needed is not None:
+                step = dict(step, columns=[column for column in step['columns'] if column in needed])
+            needed = set(step['columns'])
+        elif kind == 'delete_columns':
+            if columns_before is not None:
+                # With known columns a deletion is the same as keeping the other columns
+                kept = [column for column in columns_before if column not in step['columns']
+                        and (needed is None or column in needed)]
+                step = {'step': 'keep_columns', 'columns': kept}
+                needed = set(kept)
+            elif needed is not None:
+                needed = needed - set(step['columns'])
+        elif kind == 'split':
+            if step.get('parts') is None:
+                # The new columns are only known after splitting, so no column before this step can be dropped
+                needed = None
+            else:
+                new_columns = set(get_split_column_names(step['column'], step['parts']))
+                if needed is not None:
+                    if not needed & new_columns:
+                        continue
+                    needed = (needed - new_columns) | {step['column']}
+        elif kind == 'concat':
+            if needed is not None:
+                if step['name'] not in needed:
+                    continue
+                needed = (needed - {step['name']}) | set(step['columns'])
+        elif kind == 'convert':
+            if needed is not None:
+                if step.get('non_finite') != 'drop':
+                    # Only the columns that are still needed are converted
+                    step = dict(step, columns=[column for column in step['columns'] if column in needed])
+                    if not step['columns']:
+                        continue
+                needed = needed | set(step['columns'])
+        elif kind == 'duplicates':
+            if needed is not None and not step['use_index']:
+                needed = needed | set(get_key_columns(step['column']))
+        elif kind == 'missing' and step['action'] == 'delete':
+            # Rows are deleted for a missing value in any column, so every column before this step is needed
+            needed = None
+        elif kind == 'drop_duplicate_columns':
+            # Which copy is kept depends on all columns, so every column before this step is needed
+            needed = None
+        pruned.append(step)
+    pruned.reverse()
+    return pruned, needed
+
+# Function to get the columns of the data that the cleaning steps need, None when all columns are needed
+def get_needed_columns(steps, columns):
+    _, needed = prune_cleaning_steps(steps, columns)
+    if needed is None:
+        return None
+    return [column for column in columns if column in needed]
+
+# Function to turn the recorded cleaning steps into a plan for data with these columns
+def plan_cleaning_steps(steps, columns):
+    columns = list(columns)
+    pruned, needed = prune_cleaning_steps(steps, columns)
+    plan = []
+    if needed is not None and len(needed) < len(columns):
+        plan.append({'step': 'keep_columns', 'columns': [column for column in columns if column in needed]})
+    for step in pruned:
+        previous = plan[-1] if plan else None
+        if step['step'] in ('split', 'concat'):
+            if previous is not None and previous['step'] == 'add_columns' and previous['columns'] is None:
+                previous['steps'].append(step)
+            else:
+                plan.append({'step': 'add_columns', 'steps': [step], 'columns': None})
+        elif step['step'] == 'keep_columns' and previous is not None and previous['step'] == 'add_columns' \
+                and previous['columns'] is None:
+            # The new columns and the selection after them make one new DataFrame
+            previous['columns'] = list(step['columns'])
+        elif step['step'] == 'convert' and step.get('non_finite') is None and previous is not None \
+                and previous['step'] == 'convert_columns' \
+                and not set(step['columns']) & set(previous['dtypes']):
+            previous['dtypes'].update({column: conversion_dtypes[step['type']] for column in step['columns']})
+        elif step['step'] == 'convert' and step.get('non_finite') is None and step['type'] in conversion_dtypes:
+            plan.append({'step': 'convert_columns',
+                         'dtypes': {column: conversion_dtypes[step['type']] for column in step['columns']}})
+        else:
+            plan.append(step)
+    return plan
+
+# Function to run adjacent split and concatenate steps at once, the new columns (and the selected old ones)
+# are put together in a single new DataFrame
+def add_columns(df, steps, columns=None):
+    new_columns = {}
+    get_values = lambda column: new_columns[column] if column in new_columns else df[column]
+    for step in steps:
+        if step['step'] == 'split':
+            new_columns.update(split_values(get_values(step['column']), step['column'], step['separator'],
+                                            step.get('parts')).items())
+        else:
+            values = pd.DataFrame({column: get_values(column) for column in step['columns']}, index=df.index)
+            new_columns[step['name']] = concatenate_columns(values, step['columns'], step['separator'], step['name'])
+    if columns is None:
+        columns = list(df.columns) + [column for column in new_columns if column not in df.columns]
+    return pd.DataFrame({column: get_values(column) for column in columns}, index=df.index)
+
+# Functions to replay the recorded cleaning steps on a file, one chunk at a time
+# Only the keys of the duplicate column (not the rows) are kept in memory between chunks
+# For a composite key these are the 64-bit row hashes, which are checked for collisions within every chunk
+# The steps never change a chunk in place, because the same chunk can be read again by a later pass
+
+# Function to get the duplicate keys of a chunk for a recorded duplicates step
+def get_step_keys(chunk, step):
+    return get_duplicate_keys(chunk, step['column'], step['use_index'], step.get('match', 'exact'), step.get('similar_keys'))
+
+# Function to find the groups of similar keys over the whole file, so every chunk uses the same groups
+# Only the distinct normalized keys of every key column are kept in memory
+def find_similar_keys_in_chunks(chunks, step):
+    columns = [None] if step['use_index'] else get_key_columns(step['column'])
+    distinct_keys = {column: set() for column in columns}
+    for chunk in chunks:
+        for column in columns:
+            keys = normalize_keys(chunk.index.to_series(index=chunk.index) if column is None else chunk[column])
+            if pd.api.types.is_string_dtype(keys.dtype):
+                distinct_keys[column].update(keys.dropna().unique().tolist())
+    return {column: find_similar_keys(pd.Series(list(keys), dtype='str')) for column, keys in distinct_keys.items() if keys}
+
+# Function to count how often every key occurs in the whole (partly cleaned) file
+def count_keys_in_chunks(chunks, step):
+    key_counts = pd.Series(dtype='int64')
+    for chunk in chunks:
+        key_counts = key_counts.add(get_step_keys(chunk, step).value_counts(dropna=False), fill_value=0)
+    return key_counts
+
+# Function to find the row number of the last occurrence of every key in the whole file
+def find_last_positions_in_chunks(chunks, step):
+    last_positions = {}
+    offset = 0
+    for chunk in chunks:
+        keys = get_step_keys(chunk, step)
+        positions = pd.Series(np.arange(offset, offset + len(chunk)), index=keys.values)
+        last_positions.update(positions[~positions.index.duplicated(keep='last')].to_dict())
+        offset += len(chunk)
+    return last_positions
+
+# Function to sum up the numeric columns of the duplicated keys only, to take their mean afterwards
+def sum_duplicates_in_chunks(chunks, step, duplicated_keys):
+    sums = None
+    counts = None
+    for chunk in chunks:
+        keys = get_step_keys(chunk, step)
+        is_duplicated = keys.isin(duplicated_keys).values
+        numeric = chunk.loc[is_duplicated, get_mean_columns(chunk, step['column'], step['use_index'])]
+        grouped = numeric.groupby(keys[is_duplicated].values, observed=True, dropna=False)
+        sums = grouped.sum() if sums is None else sums.add(grouped.sum(), fill_value=0)
+        counts = grouped.count() if counts is None else counts.add(grouped.count(), fill_value=0)
+    if sums is None:
+        return pd.DataFrame()
+    return sums / counts
+
+# Function to handle duplicates chunk by chunk
+# prepass_chunks is a function that reads the file again up to this step, it is only needed for 'last' and 'mean'
+# and for similar keys
+def stream_duplicates(chunks, step, prepass_chunks):
+    action = step['action']
+    if action == 'Ignore':
+        yield from chunks
+        return
+    if step.get('match') == 'similar':
+        step = dict(step, similar_keys=find_similar_keys_in_chunks(prepass_chunks(), step))
+    if action == 'Choose only the last value':
+        last_positions = find_last_positions_in_chunks(prepass_chunks(), step)
+    elif action == 'Take mean of duplicates':
+        key_counts = count_keys_in_chunks(prepass_chunks(), step)
+        duplicated_keys = key_counts.index[key_counts > 1]
+        means = sum_duplicates_in_chunks(prepass_chunks(), step, duplicated_keys)
+    seen_keys = set()
+    offset = 0
+    for chunk in chunks:
+        keys = get_step_keys(chunk, step)
+        if action == 'Choose only the last value':
+            positions = np.arange(offset, offset + len(chunk))
+            keep = keys.map(last_positions).values == positions
+        else:
+            # Keep the first occurrence of every key, also over the previous chunks
+            keep = ~(keys.duplicated(keep='first') | keys.isin(seen_keys)).values
+            seen_keys.update(keys[keep].tolist())
+        offset += len(chunk)
+        chunk = chunk[keep]
+        if action == 'Take mean of duplicates' and not means.empty:
+            # Replace the numeric values of the duplicated keys by their mean, all columns in one go
+            kept_keys = keys[keep]
+            has_mean = kept_keys.isin(means.index).values
+            mean_values = means.reindex(kept_keys.values).to_numpy(dtype='float64', na_value=np.nan)
+            values = np.where(has_mean[:, None], mean_values, chunk[means.columns].to_numpy(dtype='float64', na_value=np.nan))
+            chunk = replace_columns(chunk, [pd.DataFrame(values, index=chunk.index, columns=means.columns)])
+        yield chunk
+
+# Function to find the columns that are identical in every chunk of the whole (partly cleaned) file
+# After the first chunk only the columns that are still in a group are compared, and a group is split up as soon as
+# one chunk has different values in its columns. Chunks without rows say nothing about the columns and are skipped
+def find_duplicate_columns_in_chunks(chunks):
+    groups = None
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        if groups is None:
+            groups = find_duplicate_columns(chunk)
+        else:
+            labels = {column: group[0] for group in find_duplicate_columns(chunk[[column for group in groups for column in group]])
+                      for column in group}
+            split_groups = []
+            for group in groups:
+                same_values = {}
+                for column in group:
+                    same_values.setdefault(labels.get(column, column), []).append(column)
+                split_groups.extend(columns for columns in same_values.values() if len(columns) > 1)
+            groups = split_groups
+        if not groups:
+            break
+    return groups or []
+
+# Function to drop the copies of identical columns chunk by chunk, the columns are compared over the whole file first
+# prepass_chunks is a function that reads the file again up to this step
+def stream_drop_duplicate_columns(chunks, prepass_chunks):
+    redundant_columns = get_redundant_columns(find_duplicate_columns_in_chunks(prepass_chunks()))
+    for chunk in chunks:
+        yield delete_columns(chunk, redundant_columns)
+
+# Function to apply one of the other (row by row) cleaning steps to a chunk
+def apply_step_to_chunk(chunk, step):
+    if step['step'] == 'missing':
+        if step['action'] == 'delete':
+            return remove_rows_with_missing_values(chunk)
+        return fill_missing_values(chunk, step['value'])
+    if step['step'] == 'convert':
+        return convert_columns(chunk, step['columns'], step['type'], step.get('non_finite'), step.get('replace_value', 0))
+    if step['step'] == 'split':
+        # In chunks every chunk is split into the same number of columns as the preview
+        return pd.concat([chunk, split_column(chunk, step['column'], step['separator'], step.get('parts'))], axis=1)
+    if step['step'] == 'concat':
+        return pd.concat([chunk, concatenate_columns(chunk, step['columns'], step['separator'], step['name'])], axis=1)
+    if step['step'] == 'keep_columns':
+        return keep_columns(chunk, step['columns'])
+    if step['step'] == 'delete_columns':
+        return delete_columns(chunk, step['columns'])
+    if step['step'] == 'add_columns':
+        return add_columns(chunk, step['steps'], step['columns'])
+    if step['step'] == 'convert_columns':
+        return astype_columns(chunk, step['dtypes'])
+    return chunk
+
+# Function to apply one of the row by row cleaning steps to every chunk
+def apply_step_to_chunks(chunks, step):
+    for chunk in chunks:
+        yield apply_step_to_chunk(chunk, step)
+
+# Function to run a plan on the chunks of a file
+# open_chunks is a function that starts reading the file from the beginning
+def run_plan(chunks, plan, open_chunks):
+    for i, step in enumerate(plan):
+        prepass_chunks = lambda i=i: run_plan(open_chunks(), plan[:i], open_chunks)
+        if step['step'] == 'duplicates':
+            chunks = stream_duplicates(chunks, step, prepass_chunks)
+        elif step['step'] == 'drop_duplicate_columns':
+            chunks = stream_drop_duplicate_columns(chunks, prepass_chunks)
+        else:
+            chunks = apply_step_to_chunks(chunks, step)
+    return chunks
+
+# Function to apply all the recorded cleaning steps to the chunks of a file
+# The steps are planned with the columns of the first chunk
+def stream_cleaning_steps(open_chunks, steps):
+    chunks = open_chunks()
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return iter(())
+    plan = plan_cleaning_steps(steps, first_chunk.columns)
+    return run_plan(itertools.chain([first_chunk], chunks), plan, open_chunks)
+
+# Function to clean the whole file chunk by chunk and write the result to a CSV file in output_folder
+# progress (optional) is called after every chunk with the number of rows written so far, it can stop the
+# cleaning by raising an exception (the unfinished file is then removed)
+def clean_file_in_chunks(open_chunks, steps, output_folder, progress=None):
+    os.makedirs(output_folder, exist_ok=True)
+    output = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', dir=output_folder, delete=False, newline='')
+    try:
+        with output:
+            header = True
+            rows = 0
+            for chunk in stream_cleaning_steps(open_chunks, steps):
+                chunk.to_csv(output, header=header, index=True)
+                header = False
+                rows += len(chunk)
+                if progress is not None:
+                    progress(rows)
+    except BaseException:
+        os.remove(output.name)
+        raise
+    return output.name
+
+# Function to clean a whole DataFrame with the recorded cleaning steps (as a single chunk)
+def clean_dataframe(df, steps):
+    return next(stream_cleaning_steps(lambda: iter([df]), steps))
+
+# Functions to save the recorded cleaning steps as a recipe and load them again
+# A recipe is a plain JSON (or YAML) file: {"recipe_version": 1, "steps": [...]} with the step dictionaries
+# recorded by the webtool, so it can be edited by hand and replayed on new files
+recipe_version = 1
+recipe_formats = {'JSON': 'json', 'YAML': 'yaml'}
+
+# Keys every step needs, the other keys are optional
+recipe_step_keys = {
+    'duplicates': ('column', 'action', 'use_index'),
+    'missing': ('action',),
+    'convert': ('type', 'columns'),
+    'split': ('column', 'separator'),
+    'concat': ('columns', 'separator', 'name'),
+    'keep_columns': ('columns',),
+    'delete_columns': ('columns',),
+    'drop_duplicate_columns': (),
+}
+
+# Function to check the steps of a recipe, so a wrong recipe fails before any file is read
+def check_recipe_steps(steps):
+    if not isinstance(steps, list):
+        raise ValueError('The steps of a recipe must be a list.')
+    for number, step in enumerate(steps, start=1):
+        if not isinstance(step, dict) or step.get('step') not in recipe_step_keys:
+            raise ValueError(f'Step {number} of the recipe is not a known cleaning step.')
+        missing_keys = [key for key in recipe_step_keys[step['step']] if key not in step]
+        if missing_keys:
+            raise ValueError(f'Step {number} ({step["step"]}) of the recipe misses: {", ".join(missing_keys)}.')
+        if step['step'] == 'duplicates' and step['action'] not in duplicate_actions:
+            raise ValueError(f'Step {number} has an unknown duplicate action: {step["action"]}.')
+        if step['step'] == 'duplicates' and step.get('match', 'exact') not in duplicate_matches:
+            raise ValueError(f'Step {number} has an unknown way to match duplicates: {step["match"]}.')
+        if step['step'] == 'missing' and step['action'] not in ('delete', 'fill'):
+            raise ValueError(f'Step {number} has an unknown missing value action: {step["action"]}.')
+        if step['step'] == 'convert' and step['type'] not in conversion_types:
+            raise ValueError(f'Step {number} has an unknown conversion type: {step["type"]}.')
+        if step['step'] == 'convert' and step.get('non_finite') not in (None,) + non_finite_actions:
+            raise ValueError(f'Step {number} has an unknown action for missing and infinite values: {step["non_finite"]}.')
+        if step['step'] == 'split' and step.get('parts') is not None and \
+                (not isinstance(step['parts'], int) or isinstance(step['parts'], bool) or step['parts'] < 1):
+            raise ValueError(f'Step {number} must split into at least 1 column, not {step["parts"]!r}.')
+    return steps
+
+# Function to write the cleaning steps as a recipe in JSON or YAML
+def dump_recipe(steps, recipe_format='JSON'):
+    recipe = {'recipe_version': recipe_version, 'steps': check_recipe_steps(list(steps))}
+    if recipe_format == 'YAML':
+        if yaml is None:
+            raise ImportError('YAML recipes need the PyYAML package (pip install pyyaml)')
+        return yaml.safe_dump(recipe, sort_keys=False, allow_unicode=True)
+    return json.dumps(recipe, indent=2, ensure_ascii=False)
+
+# Function to read the cleaning steps from a recipe, JSON is valid YAML so both are read the same way
+def load_recipe(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf-8-sig')
+    try:
+        recipe = json.loads(text)
+    except json.JSONDecodeError:
+        if yaml is None:
+            raise ValueError('The recipe is not valid JSON (YAML recipes need the PyYAML package).')
+        try:
+            recipe = yaml.safe_load(text)
+        except yaml.YAMLError as error:
+            raise ValueError(f'The recipe is not valid JSON or YAML: {error}')
+    if not isinstance(recipe, dict) or 'steps' not in recipe:
+        raise ValueError('The recipe has no cleaning steps.')
+    if recipe.get('recipe_version', recipe_version) > recipe_version:
+        raise ValueError('The recipe was made by a newer version of the webtool.')
+    return check_recipe_steps(recipe['steps'])
+
+# File formats of input files by file extension, and the extensions of compressed files
+input_formats = {'.xlsx': 'Excel', '.xls': 'Excel', '.csv': 'CSV', '.tsv': 'TSV', '.txt': 'TSV',
+                 '.parquet': 'Parquet', '.feather': 'Feather', '.arrow': 'Feather'}
+compressed_extensions = ('.gz', '.bz2', '.zst', '.zip')
+
+# Function to remove the compression extension from a file name
+def strip_compressed_extension(file_name):
+    for compressed_extension in compressed_extensions:
+        if file_name.lower().endswith(compressed_extension):
+            return file_name[:-len(compressed_extension)]
+    return file_name
+
+# Function to get the file format of an input file from its extension, None when it is not known
+def guess_input_format(file_name):
+    return input_formats.get(os.path.splitext(strip_compressed_extension(file_name).lower())[1])
+
+# Function to get the name of the cleaned file: data.csv.gz becomes data_cleaned.<extension of output_format>
+def get_cleaned_file_name(file_name, output_format):
+    extension, _ = download_formats[output_format]
+    return os.path.splitext(strip_compressed_extension(os.path.basename(file_name)))[0] + '_cleaned.' + extension
+
+# Function used by the worker processes of the batch mode: read one file, clean it and write the result
+# to output_folder. Errors are returned instead of raised, so one bad file does not stop the whole batch.
+# Without data the file is read from disk (file_name is then its path)
+def clean_batch_file(file_name, data, file_format, steps, output_format, output_folder):
+    try:
+        if data is None:
+            with open(file_name, 'rb') as file:
+                data = file.read()
+        upload = io.BytesIO(data)
+        compression = detect_compression(upload, file_format)
+        if compression is not None:
+            member = get_zip_members(upload)[0] if compression == 'zip' else None
+            upload = open_compressed_upload(upload, file_format, compression, member)
+        read_options = {}
+        if file_format in ('CSV', 'TSV'):
+            read_options = sniff_csv_schema(upload, ',' if file_format == 'CSV' else '\t')
+        elif file_format in ('Parquet', 'Feather'):
+            # Only the columns the cleaning steps need are read
+            schema = get_arrow_schema(upload, file_format)
+            index_columns = get_arrow_index_columns(schema)
+            columns = [column for column in schema.names if column not in index_columns]
+            read_options = {'columns': get_needed_columns(steps, columns)}
+        df = clean_dataframe(read_uploaded_file(upload, file_format, **read_options), steps)
+        output_name = get_cleaned_file_name(file_name, output_format)
+        write_download_file(df, os.path.join(output_folder, output_name), output_format)
+        return file_name, output_name, None
+    except Exception as error:
+        return file_name, None, f'{type(error).__name__}: {error}'
@@ -0,0 +1,254 @@
+# HTTP service of the data cleaning webtool, so pipelines can call the cleaning operations without the Streamlit page
+# Start it with:
+#   python cleaning_service.py --port 8000 --workers 4
+# and see http://localhost:8000/docs for all endpoints. It needs: pip install fastapi uvicorn python-multipart
+#
+# Every operation of the webtool has its own endpoint (/duplicates, /missing, /convert, /split, /concat and /columns),
+# which takes a file and returns the cleaned file in the chosen output format. /clean runs a whole recipe.
+# Large files are better sent to /jobs: the job runs in the worker pool, its status can be polled at /jobs/<id>
+# and the cleaned file is streamed from /jobs/<id>/result when it is done.
+# All cleaning runs in a pool of worker processes, so the service keeps answering while files are being cleaned.
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
+
+from cleaning_engine import (download_formats, duplicate_action_names, duplicate_matches, conversion_type_names,
+                             guess_input_format, load_recipe, check_recipe_steps, clean_batch_file)
+
+# Folder for the uploaded and cleaned files of the service
+service_folder = os.path.join(tempfile.gettempdir(), 'data_cleaning_webtool', 'service')
+# Finished jobs (and their files) are removed after this time
+job_max_age_hours = 24
+# Number of worker processes, changed with --workers
+worker_count = os.cpu_count() or 1
+
+# Jobs by job id: {'status', 'file_name', 'folder', 'output_name', 'error', 'created'}
+jobs = {}
+
+@asynccontextmanager
+async def lifespan(app):
+    # The workers are started with 'spawn', like the batch mode of the webtool
+    app.state.pool = ProcessPoolExecutor(max_workers=worker_count, mp_context=multiprocessing.get_context('spawn'))
+    os.makedirs(service_folder, exist_ok=True)
+    yield
+    app.state.pool.shutdown(cancel_futures=True)
+
+app = FastAPI(title='Data cleaning webtool', description='The cleaning operations of the data cleaning webtool.',
+              lifespan=lifespan)
+
+# Function to save an uploaded file in a new folder, the file is copied in a thread so the service keeps answering
+# Only the last part of the file name is used, and names that are not a file name ('', '.' or '..') become 'upload'
+# The folder is removed again when the file cannot be saved
+async def save_upload(upload):
+    file_name = os.path.basename(upload.filename or '')
+    if file_name in ('', '.', '..'):
+        file_name = 'upload'
+    folder = tempfile.mkdtemp(dir=service_folder)
+    path = os.path.join(folder, file_name)
+    def copy_upload():
+        with open(path, 'wb') as file:
+            shutil.copyfileobj(upload.file, file, 16 * 1024 * 1024)
+    try:
+        await run_in_threadpool(copy_upload)
+    except BaseException:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    return folder, path
+
+# Function to check the file format and the output format of a request
+def get_formats(upload, file_format, output_format):
+    file_format = file_format or guess_input_format(upload.filename or '')
+    if file_format is None:
+        raise HTTPException(400, 'Cannot guess the file format from the file name, please give file_format.')
+    if output_format not in download_formats:
+        raise HTTPException(400, f'output_format must be one of: {", ".join(download_formats)}.')
+    return file_format, output_format
+
+# Function to clean an uploaded file in the worker pool and send the cleaned file back
+# The files are removed after the response is sent
+async def clean_upload(upload, file_format, steps, output_format):
+    file_format, output_format = get_formats(upload, file_format, output_format)
+    try:
+        check_recipe_steps(steps)
+    except ValueError as error:
+        raise HTTPException(400, str(error))
+    folder, path = await save_upload(upload)
+    try:
+        future = app.state.pool.submit(clean_batch_file, path, None, file_format, steps, output_format, folder)
+        _, output_name, error = await asyncio.wrap_future(future)
+    except Exception:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    if error is not None:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise HTTPException(422, error)
+    return FileResponse(os.path.join(folder, output_name), media_type=download_formats[output_format][1],
+                        filename=output_name, background=BackgroundTask(shutil.rmtree, folder, ignore_errors=True))
+
+# Function to read a recipe sent as text or as a file
+async def read_recipe(recipe, recipe_file):
+    if recipe_file is not None:
+        recipe = await recipe_file.read()
+    if not recipe:
+        raise HTTPException(400, 'Please send a recipe (as text or as a file).')
+    try:
+        return load_recipe(recipe)
+    except ValueError as error:
+        raise HTTPException(400, str(error))
+
+# Endpoints for the single cleaning operations
+@app.post('/duplicates', summary='Handle duplicate values in a column, several columns or the index')
+async def duplicates(file: UploadFile = File(...), column: Optional[List[str]] = Form(None), use_index: bool = Form(False),
+                     action: str = Form('first'), match: str = Form('exact'), file_format: Optional[str] = Form(None),
+                     output_format: str = Form('CSV')):
+    if action not in duplicate_action_names:
+        raise HTTPException(400, f'action must be one of: {", ".join(duplicate_action_names)}.')
+    if match not in duplicate_matches:
+        raise HTTPException(400, f'match must be one of: {", ".join(duplicate_matches)}.')
+    if not column and not use_index:
+        raise HTTPException(400, 'Please give a column or use_index.')
+    if column and len(column) == 1:
+        # Several columns (the column field given more than once) are checked together as one key
+        column = column[0]
+    step = {'step': 'duplicates', 'column': column, 'action': duplicate_action_names[action], 'use_index': use_index}
+    if match != 'exact':
+        step['match'] = match
+    return await clean_upload(file, file_format, [step], output_format)
+
+@app.post('/missing', summary='Delete or fill rows with missing values')
+async def missing(file: UploadFile = File(...), action: str = Form('delete'), value: str = Form(''),
+                  file_format: Optional[str] = Form(None), output_format: str = Form('CSV')):
+    step = {'step': 'missing', 'action': action}
+    if action == 'fill':
+        step['value'] = value
+    return await clean_upload(file, file_format, [step], output_format)
+
+@app.post('/convert', summary='Convert columns to integers, floats or strings')
+async def convert(file: UploadFile = File(...), columns: List[str] = Form(...), type: str = Form(...),
+                  non_finite: Optional[str] = Form(None), replace_value: float = Form(0),
+                  file_format: Optional[str] = Form(None), output_format: str = Form('CSV')):
+    if type not in conversion_type_names:
+        raise HTTPException(400, f'type must be one of: {", ".join(conversion_type_names)}.')
+    step = {'step': 'convert', 'type': conversion_type_names[type], 'columns': columns}
+    if non_finite:
+        step.update({'non_finite': non_finite, 'replace_value': replace_value})
+    return await clean_upload(file, file_format, [step], output_format)
+
+@app.post('/split', summary='Split a column into new columns')
+async def split(file: UploadFile = File(...), column: str = Form(...), separator: str = Form(','),
+                parts: Optional[int] = Form(None), file_format: Optional[str] = Form(None), output_format: str = Form('CSV')):
+    step = {'step': 'split', 'column': column, 'separator': separator, 'parts': parts}
+    return await clean_upload(file, file_format, [step], output_format)
+
+@app.post('/concat', summary='Concatenate columns into a new column')
+async def concat(file: UploadFile = File(...), columns: List[str] = Form(...), separator: str = Form(' '),
+                 name: str = Form('Concatenated_Column'), file_format: Optional[str] = Form(None),
+                 output_format: str = Form('CSV')):
+    step = {'step': 'concat', 'columns': columns, 'separator': separator, 'name': name}
+    return await clean_upload(file, file_format, [step], output_format)
+
+@app.post('/columns', summary='Keep or delete columns')
+async def select_columns(file: UploadFile = File(...), keep: Optional[List[str]] = Form(None),
+                         delete: Optional[List[str]] = Form(None), file_format: Optional[str] = Form(None),
+                         output_format: str = Form('CSV')):
+    if bool(keep) == bool(delete):
+        raise HTTPException(400, 'Please give either the columns to keep or the columns to delete.')
+    step = {'step': 'keep_columns', 'columns': keep} if keep else {'step': 'delete_columns', 'columns': delete}
+    return await clean_upload(file, file_format, [step], output_format)
+
+@app.post('/clean', summary='Clean a file with a recipe and return the cleaned file')
+async def clean(file: UploadFile = File(...), recipe: Optional[str] = Form(None), recipe_file: Optional[UploadFile] = File(None),
+                file_format: Optional[str] = Form(None), output_format: str = Form('CSV')):
+    return await clean_upload(file, file_format, await read_recipe(recipe, recipe_file), output_format)
+
+# Endpoints for cleaning jobs that run in the background
+# Function to remove finished jobs that are older than job_max_age_hours
+def remove_old_jobs():
+    now = time.time()
+    for job_id, job in list(jobs.items()):
+        if job['status'] in ('done', 'failed') and now - job['created'] > job_max_age_hours * 3600:
+            shutil.rmtree(job['folder'], ignore_errors=True)
+            del jobs[job_id]
+
+# Function to run a job in the worker pool and keep its status up to date
+async def run_job(job_id, path, file_format, steps, output_format):
+    job = jobs[job_id]
+    job['status'] = 'running'
+    future = app.state.pool.submit(clean_batch_file, path, None, file_format, steps, output_format, job['folder'])
+    try:
+        _, job['output_name'], job['error'] = await asyncio.wrap_future(future)
+    except Exception as error:
+        job['error'] = f'{type(error).__name__}: {error}'
+    job['status'] = 'failed' if job['error'] else 'done'
+    os.remove(path)
+
+@app.post('/jobs', status_code=202, summary='Start a cleaning job with a recipe')
+async def create_job(file: UploadFile = File(...), recipe: Optional[str] = Form(None),
+                     recipe_file: Optional[UploadFile] = File(None), file_format: Optional[str] = Form(None),
+                     output_format: str = Form('CSV')):
+    file_format, output_format = get_formats(file, file_format, output_format)
+    steps = await read_recipe(recipe, recipe_file)
+    remove_old_jobs()
+    folder, path = await save_upload(file)
+    job_id = uuid.uuid4().hex
+    jobs[job_id] = {'status': 'queued', 'file_name': file.filename, 'folder': folder, 'output_name': None,
+                    'error': None, 'created': time.time()}
+    # The task keeps running after the response is sent, the asyncio loop keeps a reference to it in jobs
+    jobs[job_id]['task'] = asyncio.create_task(run_job(job_id, path, file_format, steps, output_format))
+    return {'job_id': job_id, 'status': 'queued'}
+
+# Function to get a job or answer 404
+def get_job(job_id):
+    if job_id not in jobs:
+        raise HTTPException(404, 'Job not found.')
+    return jobs[job_id]
+
+@app.get('/jobs/{job_id}', summary='Status of a cleaning job')
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    return {'job_id': job_id, 'status': job['status'], 'file_name': job['file_name'], 'error': job['error'],
+            'result': f'/jobs/{job_id}/result' if job['status'] == 'done' else None}
+
+@app.get('/jobs/{job_id}/result', summary='Download the cleaned file of a finished job')
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if job['status'] != 'done':
+        raise HTTPException(409, f'The job is {job["status"]}.')
+    output_name = job['output_name']
+    extension = os.path.splitext(output_name)[1][1:]
+    media_type = next((mime_type for file_extension, mime_type in download_formats.values() if file_extension == extension),
+                      'application/octet-stream')
+    return FileResponse(os.path.join(job['folder'], output_name), media_type=media_type, filename=output_name)
+
+@app.delete('/jobs/{job_id}', summary='Remove a job and its files')
+async def delete_job(job_id: str):
+    job = get_job(job_id)
+    if job['status'] in ('queued', 'running'):
+        raise HTTPException(409, 'The job is still running.')
+    shutil.rmtree(job['folder'], ignore_errors=True)
+    del jobs[job_id]
+    return {'job_id': job_id, 'status': 'deleted'}
+
+if __name__ == '__main__':
+    import uvicorn
+    parser = argparse.ArgumentParser(description='HTTP service of the data cleaning webtool.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    parser.add_argument('--workers', type=int, default=worker_count, help='number of worker processes (default: one per core)')
+    args = parser.parse_args()
+    worker_count = args.workers
+    uvicorn.run(app, host=args.host, port=args.port)
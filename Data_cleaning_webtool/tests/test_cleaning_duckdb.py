@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cleaning_engine import pa, clean_dataframe
+from cleaning_duckdb import duckdb, clean_file_with_duckdb
+
+pytestmark = pytest.mark.skipif(duckdb is None, reason='needs duckdb')
+
+concat_step = {'step': 'concat', 'columns': ['gene', 'score', 'sample'], 'separator': '_', 'name': 'key'}
+
+# Data with missing text (NULL in DuckDB) and missing numbers (NaN in Parquet files, NULL in CSV files)
+def make_data_with_missing_values():
+    return pd.DataFrame({'gene': ['TP53', None, 'EGFR', 'KRAS'], 'score': [1.5, 2.25, np.nan, 3.0],
+                         'sample': ['s1', 's2', None, None]}, index=pd.Index(['r1', 'r2', 'r3', 'r4'], name='id'))
+
+# Function to clean a file with both backends and read back the cleaned files
+def clean_with_both_backends(tmp_path, df, file_format, steps):
+    path = tmp_path / f'data.{file_format.lower()}'
+    if file_format == 'Parquet':
+        df.to_parquet(path)
+        pandas_df = pd.read_parquet(path)
+    else:
+        df.to_csv(path)
+        pandas_df = pd.read_csv(path, index_col=0)
+    pandas_cleaned = clean_dataframe(pandas_df, steps)
+    output_path = tmp_path / 'cleaned.csv'
+    clean_file_with_duckdb(str(path), file_format, steps, str(output_path), 'CSV')
+    return pandas_cleaned, pd.read_csv(output_path, index_col=0, keep_default_na=False)
+
+@pytest.mark.parametrize('file_format', ['CSV', pytest.param('Parquet', marks=pytest.mark.skipif(pa is None, reason='needs pyarrow'))])
+def test_concat_with_missing_values_is_the_same_in_both_backends(tmp_path, file_format):
+    pandas_cleaned, duckdb_cleaned = clean_with_both_backends(tmp_path, make_data_with_missing_values(), file_format, [concat_step])
+    assert duckdb_cleaned['key'].tolist() == pandas_cleaned['key'].tolist()
+    assert pandas_cleaned['key'].tolist() == ['TP53_1.5_s1', 'nan_2.25_s2', 'EGFR_nan_nan', 'KRAS_3.0_nan']
@@ -0,0 +1,62 @@
+import datetime
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cleaning_engine import (pa, feather, dataframe_to_arrow_table, arrow_table_to_dataframe, read_uploaded_file,
+                             concatenate_columns, clean_dataframe)
+
+# Function to write a DataFrame to an in-memory Parquet or Feather file, as it would be uploaded
+def make_arrow_upload(df, file_format):
+    upload = io.BytesIO()
+    if file_format == 'Parquet':
+        df.to_parquet(upload)
+    else:
+        feather.write_feather(dataframe_to_arrow_table(df), upload)
+    upload.seek(0)
+    return upload
+
+@pytest.mark.skipif(pa is None, reason='needs pyarrow')
+@pytest.mark.parametrize('file_format', ['Parquet', 'Feather'])
+@pytest.mark.parametrize('columns', [None, []])
+def test_read_arrow_file_without_selected_columns_loads_all_columns(file_format, columns):
+    df = pd.DataFrame({'id': ['a', 'b', 'c'], 'x': [1, 2, 3], 'y': [0.5, np.nan, 2.5]}).set_index('id')
+    loaded = read_uploaded_file(make_arrow_upload(df, file_format), file_format, columns=columns)
+    pd.testing.assert_frame_equal(loaded, df)
+
+@pytest.mark.skipif(pa is None, reason='needs pyarrow')
+@pytest.mark.parametrize('file_format', ['Parquet', 'Feather'])
+def test_read_arrow_file_loads_only_the_selected_columns(file_format):
+    df = pd.DataFrame({'id': ['a', 'b'], 'x': [1, 2], 'y': [0.5, 1.5]}).set_index('id')
+    loaded = read_uploaded_file(make_arrow_upload(df, file_format), file_format, columns=['y'])
+    pd.testing.assert_frame_equal(loaded, df[['y']])
+
+def test_concatenate_columns_with_missing_values():
+    df = pd.DataFrame({'gene': ['TP53', np.nan, 'EGFR'], 'score': [1.5, 2.0, np.nan],
+                       'sample': pd.Series(['s1', 's2', None], dtype='str')})
+    concatenated = concatenate_columns(df, ['gene', 'score', 'sample'], '_', 'key')
+    assert concatenated.tolist() == ['TP53_1.5_s1', 'nan_2.0_s2', 'EGFR_nan_nan']
+    assert concatenated.name == 'key'
+
+def test_concat_step_with_missing_values():
+    df = pd.DataFrame({'gene': ['TP53', np.nan], 'sample': ['s1', 's2']}, index=pd.Index(['r1', 'r2'], name='id'))
+    cleaned = clean_dataframe(df, [{'step': 'concat', 'columns': ['gene', 'sample'], 'separator': '-', 'name': 'key'}])
+    assert cleaned['key'].tolist() == ['TP53-s1', 'nan-s2']
+
+@pytest.mark.skipif(pa is None, reason='needs pyarrow')
+def test_demo_dataset_parquet_is_the_same_as_the_excel_file():
+    folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(folder, 'Streamlit_demo_dataset.xlsx'), 'rb') as excel_file:
+        excel_df = read_uploaded_file(excel_file, 'Excel')
+    with open(os.path.join(folder, 'Streamlit_demo_dataset.parquet'), 'rb') as parquet_file:
+        parquet_df = read_uploaded_file(parquet_file, 'Parquet')
+    pd.testing.assert_frame_equal(parquet_df, excel_df)
+
+@pytest.mark.skipif(pa is None, reason='needs pyarrow')
+def test_arrow_table_keeps_the_values_of_mixed_columns():
+    df = pd.DataFrame({'gene': ['TP53', datetime.datetime(2023, 3, 1), 7, 2.5, np.nan, None, True],
+                       'score': np.arange(7.0)}, index=pd.Index(list('abcdefg'), name='id'))
+    pd.testing.assert_frame_equal(arrow_table_to_dataframe(dataframe_to_arrow_table(df)), df)
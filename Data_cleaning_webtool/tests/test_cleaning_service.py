@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+pytest.importorskip('fastapi')
+pytest.importorskip('httpx')
+from fastapi.testclient import TestClient
+
+import cleaning_service
+
+@pytest.mark.parametrize('file_name', ['..', '.', '../../data.csv'])
+def test_upload_names_that_are_not_a_file_name(file_name):
+    with TestClient(cleaning_service.app) as client:
+        folders = set(os.listdir(cleaning_service.service_folder))
+        response = client.post('/duplicates', files={'file': (file_name, 'id,a\n1,x\n1,y\n')},
+                               data={'use_index': 'true', 'file_format': 'CSV'})
+        assert response.status_code == 200
+        assert response.text.splitlines() == ['id,a', '1,x']
+        assert set(os.listdir(cleaning_service.service_folder)) == folders